@@ -0,0 +1,9 @@
+from django_cron import CronJobBase, Schedule
+from .models import refresh_discord_users
+
+class DiscordCronJob(CronJobBase):
+    RUN_EVERY_MINS = 5
+    schedule = Schedule(run_every_mins=RUN_EVERY_MINS)
+    code = 'home.discord_cron_job'
+    def do(self):
+        refresh_discord_users()
@@ -1,6 +1,8 @@
 from __future__ import absolute_import, unicode_literals
 
 from django.db import models
+from django.conf import settings
+from django.core.cache import cache
 from django.utils.encoding import python_2_unicode_compatible
 from django import forms
 from wagtail.wagtailcore.models import Page, Orderable
@@ -116,14 +118,35 @@ class MyStreamBlock(StreamBlock):
     wgo = WgoBlock(label="wgo")
 
 
+def refresh_discord_users():
+    """Fetch the members of our discord server from the widget api and cache them.
+    Called by home.cron.DiscordCronJob. If discord doesn't answer, we keep the last good list."""
+    try:
+        r = requests.get(settings.DISCORD_WIDGET_URL, timeout=10)
+        r.raise_for_status()
+        disc_users = r.json()['members']
+    except (requests.RequestException, ValueError, KeyError):
+        return None
+    cache.set('discord_users', disc_users, settings.DISCORD_CACHE_TTL)
+    cache.set('discord_users_last_good', disc_users, None)
+    return disc_users
+
+
+def get_discord_users():
+    """Return the cached discord members. Never calls discord."""
+    disc_users = cache.get('discord_users')
+    if disc_users is None:
+        disc_users = cache.get('discord_users_last_good', [])
+    return disc_users
+
+
 class HomePage(Page):
      def get_context(self, request, *args, **kwargs):
          entries = EntryPage.objects.live().order_by('-date')
          blog_page = BlogPage.objects.all().first()
          allowed_forums = request.forum_permission_handler._get_forums_for_user(request.user,[ 'can_read_forum',])
          last_topics = Topic.objects.filter(forum__in = allowed_forums).order_by('-last_post_on')[:5]
-         r = requests.get('https://discordapp.com/api/guilds/287487891003932672/widget.json')
-         disc_users = r.json()['members']
+         disc_users = get_discord_users()
          context = super(HomePage, self).get_context(request, *args, **kwargs)
          context['entries'] = entries
          context['blog_page'] = blog_page
@@ -3,7 +3,7 @@ from django.contrib.auth.models import  Group
 
 # Register your models here.
 
-from .models import Sgf,User,LeagueEvent,Division,LeaguePlayer,Game,Registry
+from .models import Sgf,User,LeagueEvent,Division,LeaguePlayer,Game,Registry,Result,SgfReparseJob,ScraperRun,ScraperTask,UserStats,EventSummary
 
 #we create groups new_user, league_member and league_admin to help manage the league
 #if not Group.objects.filter(name='new_user').exists():
@@ -15,5 +15,31 @@ from .models import Sgf,User,LeagueEvent,Division,LeaguePlayer,Game,Registry
 #if not Group.objects.filter(name='league_member').exists():
  #      group = Group.objects.create(name='league_member')
 
-mymodels = [Sgf,User,LeagueEvent,Division,LeaguePlayer,Game,Registry]
+class SgfAdmin(admin.ModelAdmin):
+    list_display = ('__str__','date','result','league_valid','p_status')
+    def get_queryset(self, request):
+        return super(SgfAdmin, self).get_queryset(request).defer('sgf_text')
+
+admin.site.register(Sgf, SgfAdmin)
+
+def rebuild_standings(modeladmin, request, queryset, dry_run=False):
+    for event in queryset:
+        changes, nb_results = event.rebuild_standings(dry_run=dry_run)
+        message = str(event) + ': ' + str(len(changes)) + ' players and ' + str(nb_results) + ' results'
+        message += ' would change' if dry_run else ' changed'
+        if changes:
+            message += ' (' + ', '.join('%s %d/%d %s -> %d/%d %s' % ((player.kgs_username,) + old + new) for player, old, new in changes) + ')'
+        modeladmin.message_user(request, message)
+rebuild_standings.short_description = "Rebuild standings from games"
+
+def rebuild_standings_dry_run(modeladmin, request, queryset):
+    rebuild_standings(modeladmin, request, queryset, dry_run=True)
+rebuild_standings_dry_run.short_description = "Show what rebuilding standings would change"
+
+class LeagueEventAdmin(admin.ModelAdmin):
+    actions = [rebuild_standings_dry_run, rebuild_standings]
+
+admin.site.register(LeagueEvent, LeagueEventAdmin)
+
+mymodels = [User,Division,LeaguePlayer,Game,Registry,Result,SgfReparseJob,ScraperRun,ScraperTask,UserStats,EventSummary]
 admin.site.register(mymodels)
@@ -1,5 +1,7 @@
 from django_cron import CronJobBase, Schedule
 from .views import scraper
+from .models import SgfReparseJob
+import time
 
 class ScraperCronJob(CronJobBase):
 	RUN_EVERY_MINS = 5 # every 5 mins
@@ -8,5 +10,12 @@ class ScraperCronJob(CronJobBase):
 	def do(self):
 		scraper()
 
-
-
+class SgfReparseCronJob(CronJobBase):
+	RUN_EVERY_MINS = 1
+	schedule = Schedule(run_every_mins=RUN_EVERY_MINS)
+	code = 'league.sgf_reparse_cron_job'
+	def do(self):
+		# continue the running reparse job if any, for less than a minute
+		job = SgfReparseJob.objects.filter(status=1).first()
+		if job is not None:
+			job.run(time.monotonic() + 50)
@@ -0,0 +1,46 @@
+from django.db import models
+from django import forms
+import zlib
+
+
+class CompressedTextField(models.BinaryField):
+	'''A text field stored zlib compressed in a binary column.
+	In python the value is a str: it's compressed on save and decompressed when read from db.
+	Rows written before the column was compressed are read as they are.
+	Unlike BinaryField, it's editable: forms (admin) show it as a TextField.'''
+
+	def __init__(self, *args, **kwargs):
+		editable = kwargs.pop('editable', True)
+		super(CompressedTextField, self).__init__(*args, **kwargs)
+		self.editable = editable
+
+	def deconstruct(self):
+		# BinaryField's one expects editable=False
+		return models.Field.deconstruct(self)
+
+	def formfield(self, **kwargs):
+		defaults = {'widget': forms.Textarea}
+		defaults.update(kwargs)
+		return models.Field.formfield(self, **defaults)
+
+	def from_db_value(self, value, expression, connection, context):
+		return self.to_python(value)
+
+	def to_python(self, value):
+		# fixtures give the text itself, not base64 like BinaryField expects
+		if value is None or isinstance(value, str):
+			return value
+		value = bytes(value)
+		try:
+			return zlib.decompress(value).decode('utf-8')
+		except zlib.error:
+			return value.decode('utf-8')
+
+	def get_db_prep_value(self, value, connection, prepared=False):
+		if isinstance(value, str):
+			value = zlib.compress(value.encode('utf-8'))
+		return super(CompressedTextField, self).get_db_prep_value(value, connection, prepared)
+
+	def value_to_string(self, obj):
+		# dumpdata writes the text
+		return self.value_from_object(obj)
@@ -1,7 +1,8 @@
 from django import forms
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import  Group
-from .models import User
+from .models import User, LeaguePlayer
+from collections import OrderedDict
 
 class SgfAdminForm(forms.Form):
     sgf = forms.CharField(label='sgf data',widget=forms.Textarea(attrs={'cols': 60, 'rows': 20}))
@@ -32,13 +33,33 @@ class UploadFileForm(forms.Form):
 
 class LeagueRolloverForm(forms.Form):
     # a form related to a set of leagueplayers with one field per player.
+    # Players and divisions are loaded once here: rollover and proceed_rollover views
+    # both get the new players from get_plan().
     def __init__(self, from_event,to_event,  *args, **kwargs):
         super(LeagueRolloverForm, self).__init__(*args, **kwargs)
-        players = from_event.get_players()
-        divisions = to_event.get_divisions()
-        for player in players:
-            self.fields[ 'player_'+str(player.pk)] = forms.ChoiceField(choices=[(division.pk,division.name) for division in divisions],required=False)
+        self.from_event = from_event
+        self.to_event = to_event
+        self.players = list(from_event.get_players().select_related('user','division'))
+        self.divisions = list(to_event.get_divisions())
+        choices = [(division.pk,division.name) for division in self.divisions]
+        for player in self.players:
+            self.fields[ 'player_'+str(player.pk)] = forms.ChoiceField(choices=choices,required=False)
             # an attempt to set initial choice with same order... failed.
             #division =divisions.filter(order=player.division.order).first()
             #if division != None:
             #    self.fields['player_'+str(player.pk)].inital = (division.pk,division.name)
+
+    def get_plan(self):
+        # return an OrderedDict {division name: [new unsaved LeaguePlayer,...]} of the active players
+        # Each new player knows its previous_division for the preview.
+        # Must be called on a valid form.
+        divisions = dict((division.pk,division) for division in self.divisions)
+        plan = OrderedDict((division.name,[]) for division in self.divisions)
+        for player in self.players:
+            if player.is_active(self.from_event.min_matchs):
+                new_division = divisions[int(self.cleaned_data['player_'+str(player.pk)])]
+                new_player = LeaguePlayer(user=player.user,event = self.to_event,kgs_username = player.kgs_username,division=new_division)
+                new_player.kgs_username_lower = player.kgs_username.lower()
+                new_player.previous_division=player.division
+                plan[new_division.name].append(new_player)
+        return plan
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from league.models import LeagueEvent, EventSummary
+
+
+class Command(BaseCommand):
+	help = 'Create the missing event summaries. With --all, recompute every one of them'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--all', action='store_true', dest='all', help='also recompute existing summaries')
+
+	def handle(self, *args, **options):
+		events = LeagueEvent.objects.all()
+		if not options['all']:
+			events = events.filter(summary__isnull=True)
+		n = 0
+		for event in events:
+			EventSummary.refresh(event)
+			n += 1
+		self.stdout.write('%d event summaries computed.' % n)
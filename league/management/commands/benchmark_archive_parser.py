@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandError
+from league import utils
+from league.testdata import KGS_ARCHIVES_DIR
+import os
+import timeit
+
+
+def legacy_parse_kgs_archive(html):
+	'''the BeautifulSoup (html5lib) parser ask_kgs used before utils.parse_kgs_archive. Kept here as reference.'''
+	from bs4 import BeautifulSoup
+	soup=BeautifulSoup(html,"html5lib")
+	trs=soup.table.find_all('tr')
+	l=[]
+	for tr in trs[1:]:
+		tds=tr.find_all('td')
+		if tds[0].a is not None and tds[0].a.get_text()=='Yes':
+			url = tds[0].a.get('href')
+			if len(tds)==6 :
+				game_type = 'review'
+			else:
+				game_type = tds[5].get_text()
+			l.append({'url':url,'game_type': game_type})
+	return l
+
+
+class Command(BaseCommand):
+	help = 'Compare and time utils.parse_kgs_archive against the legacy BeautifulSoup parser on recorded kgs archive pages'
+
+	def add_arguments(self, parser):
+		parser.add_argument('files', nargs='*', help='html files of kgs archive pages (gameArchives.jsp), recorded with curl or a browser. Default: the pages of league/testdata/kgs_archives')
+		parser.add_argument('--repeat', type=int, default=5)
+
+	def handle(self, *args, **options):
+		files = options['files']
+		if not files:
+			files = [os.path.join(KGS_ARCHIVES_DIR, name) for name in sorted(os.listdir(KGS_ARCHIVES_DIR))]
+		pages = []
+		for name in files:
+			with open(name, encoding='utf-8') as f:
+				pages.append((name, f.read()))
+
+		# Both parsers must find the same games in the same order.
+		differences = 0
+		games = 0
+		for name, html in pages:
+			new = utils.parse_kgs_archive(html)
+			old = legacy_parse_kgs_archive(html)
+			games += len(old)
+			if new != old:
+				differences += 1
+				self.stdout.write('Difference on %s: %d games found, %d expected' % (name, len(new), len(old)))
+		if differences:
+			raise CommandError('%d pages parsed differently' % differences)
+
+		repeat = options['repeat']
+		htmls = [html for name, html in pages]
+		t_old = min(timeit.repeat(lambda: [legacy_parse_kgs_archive(h) for h in htmls], number=1, repeat=repeat))
+		t_new = min(timeit.repeat(lambda: [utils.parse_kgs_archive(h) for h in htmls], number=1, repeat=repeat))
+		self.stdout.write('%d pages, %d games, all parsed the same' % (len(pages), games))
+		self.stdout.write('legacy: %.2f ms  extractor: %.2f ms  (%.1fx)' % (t_old * 1000, t_new * 1000, t_old / t_new))
@@ -0,0 +1,79 @@
+from django.core.management.base import BaseCommand
+from league.models import Sgf
+from league import utils
+import datetime
+import timeit
+
+
+def legacy_parse_sgf_string(sgf_string):
+	'''the find() based parser we used before utils.tokenize_sgf. Kept here as reference.'''
+	sgf_string=sgf_string.replace(chr(160),'').replace(chr(10),'').replace(chr(13),'')
+	prop= {
+		'DT' : 'date',
+		'RE' : 'result',
+		'PB' : 'bplayer',
+		'PW' : 'wplayer',
+		'KM' : 'komi',
+		'HA' : 'handicap',
+		'SZ' : 'board_size',
+		'TM' : 'time',
+		'OT' : 'byo',
+		'PC' : 'place'
+	}
+	out={}
+	for key in prop:
+		p = sgf_string.find(key+'[')
+		if p != -1 :
+			q = sgf_string.find(']',p)
+			out[prop[key]]=sgf_string[p+3:q]
+	if 'date' in out:
+		out['date']=datetime.datetime.strptime(out['date'],"%Y-%m-%d")
+	else:
+		 out['date']=None
+	out['number_moves'] = 2*sgf_string.count(';B[')
+	code=""
+	q=0
+	for n in range(0,5):
+		p=sgf_string.find('BL[')
+		if p!=-1:
+			q=sgf_string.find(']',p)
+			code+=sgf_string[p+3:q]
+	out['check_code']=code
+	return out
+
+
+class Command(BaseCommand):
+	help = 'Compare and time utils.parse_sgf_string against the legacy parser on real KGS games'
+
+	def add_arguments(self, parser):
+		parser.add_argument('files', nargs='*', help='sgf files. Default: the league sgfs from the db')
+		parser.add_argument('--repeat', type=int, default=5)
+
+	def handle(self, *args, **options):
+		if options['files']:
+			corpus = []
+			for name in options['files']:
+				with open(name, encoding='utf-8') as f:
+					corpus.append(f.read())
+		else:
+			corpus = list(Sgf.objects.exclude(p_status=1).values_list('sgf_text', flat=True))
+		if len(corpus) == 0:
+			self.stdout.write('No sgf to parse.')
+			return
+
+		# Both parsers must agree. Note: the legacy one can be fooled by a property name
+		# inside a comment or by an escaped ]: a difference there is a legacy bug.
+		differences = 0
+		for sgf_text in corpus:
+			new = utils.parse_sgf_string(sgf_text)
+			old = legacy_parse_sgf_string(sgf_text)
+			keys = [k for k in set(new) | set(old) if new.get(k) != old.get(k)]
+			if keys:
+				differences += 1
+				self.stdout.write('Difference on ' + ', '.join(sorted(keys)) + ' for ' + sgf_text[:60])
+
+		repeat = options['repeat']
+		t_old = min(timeit.repeat(lambda: [legacy_parse_sgf_string(s) for s in corpus], number=1, repeat=repeat))
+		t_new = min(timeit.repeat(lambda: [utils.parse_sgf_string(s) for s in corpus], number=1, repeat=repeat))
+		self.stdout.write('%d sgfs, %d differences' % (len(corpus), differences))
+		self.stdout.write('legacy: %.2f ms  tokenizer: %.2f ms  (%.1fx)' % (t_old * 1000, t_new * 1000, t_old / t_new))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from league.models import Sgf
+
+CHUNK_SIZE = 500
+
+
+class Command(BaseCommand):
+	help = 'Rewrite the sgfs saved before sgf_text was compressed'
+
+	def handle(self, *args, **options):
+		# CompressedTextField reads uncompressed rows as they are and compresses on write:
+		# writing every text back is enough. Safe to run again.
+		# Rows are read by chunks of CHUNK_SIZE after the last pk, one transaction per chunk.
+		n = 0
+		last_pk = 0
+		while True:
+			chunk = list(Sgf.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'sgf_text')[:CHUNK_SIZE])
+			if len(chunk) == 0:
+				break
+			with transaction.atomic():
+				for pk, sgf_text in chunk:
+					Sgf.objects.filter(pk=pk).update(sgf_text=sgf_text)
+			last_pk = chunk[-1][0]
+			n += len(chunk)
+		self.stdout.write('Compressed %d sgfs.' % n)
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from league.models import LeaguePlayer, Result, Game
+import ast
+
+
+class Command(BaseCommand):
+	help = 'Convert the legacy LeaguePlayer.results strings to Result rows'
+
+	def handle(self, *args, **options):
+		# results strings are formated as:
+		#  {'opponent1':[{'id':game1.pk, 'r':1/0},...],'opponent2':[...]}
+		# Running it twice is harmless: games already converted are skipped.
+		game_ids = set(Game.objects.values_list('pk', flat=True))
+		done = set(Result.objects.values_list('player_id', 'game_id'))
+		players = {}
+		for player in LeaguePlayer.objects.all():
+			players[(player.event_id, player.kgs_username.lower())] = player
+		new_results = []
+		skipped = 0
+		for player in players.values():
+			if player.results in ('', '{}'):
+				continue
+			for opponent_name, games in ast.literal_eval(player.results).items():
+				opponent = players.get((player.event_id, opponent_name.lower()))
+				for game in games:
+					if opponent is None or game['id'] not in game_ids:
+						skipped += 1
+					elif (player.pk, game['id']) not in done:
+						new_results.append(Result(player=player, opponent=opponent, game_id=game['id'], win=game['r'] == 1))
+						done.add((player.pk, game['id']))
+		Result.objects.bulk_create(new_results)
+		self.stdout.write('Created %d results, skipped %d with unknown opponent or game.' % (len(new_results), skipped))
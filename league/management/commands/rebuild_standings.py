@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from league.models import LeagueEvent
+
+
+class Command(BaseCommand):
+	help = 'Recompute the standings (wins, losses, scores and results) of an event from its games'
+
+	def add_arguments(self, parser):
+		parser.add_argument('event_id', type=int)
+		parser.add_argument('--dry-run', action='store_true', dest='dry_run', help='only show what would change')
+
+	def handle(self, *args, **options):
+		event = LeagueEvent.objects.filter(pk=options['event_id']).first()
+		if event is None:
+			raise CommandError('No event with id %d' % options['event_id'])
+		changes, nb_results = event.rebuild_standings(dry_run=options['dry_run'])
+		for player, old, new in changes:
+			self.stdout.write('%s: %d/%d %s -> %d/%d %s' % ((player.kgs_username,) + old + new))
+		if options['dry_run']:
+			self.stdout.write('%s: %d players and %d results would change.' % (event, len(changes), nb_results))
+		else:
+			self.stdout.write('%s: %d players and %d results changed.' % (event, len(changes), nb_results))
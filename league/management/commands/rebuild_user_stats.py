@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from league.models import UserStats
+
+
+class Command(BaseCommand):
+	help = 'Recompute the career stats (games, wins, losses, events, last active) of every user'
+
+	def handle(self, *args, **options):
+		n = UserStats.rebuild()
+		self.stdout.write('Rebuilt the stats of %d users.' % n)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models.functions import Lower
+from league.models import LeaguePlayer
+
+
+class Command(BaseCommand):
+	help = 'Fill LeaguePlayer.kgs_username_lower for players saved before it existed'
+
+	def handle(self, *args, **options):
+		with transaction.atomic():
+			n = LeaguePlayer.objects.update(kgs_username_lower=Lower('kgs_username'))
+		self.stdout.write('Updated %d players.' % n)
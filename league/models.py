@@ -1,8 +1,18 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Case, When, Value, Count, Sum, F, Q, IntegerField, Max
+from django.core.cache import cache
 from django.utils import timezone
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 import datetime
+import time
+from decimal import Decimal
+import json
+import hashlib
+import uuid
+import multiprocessing
 from . import utils
-import requests
+from .fields import CompressedTextField
 from django.contrib.auth.models import AbstractUser
 
 
@@ -28,28 +38,81 @@ class LeagueEvent(models.Model):
 	def get_month(self):
 		return self.begin_time.month
 
+	# Pages of an event are cached under keys including its version (see league templates).
+	# The version is bumped whenever a game, player or division of the event changes,
+	# so cached fragments are served until something actually changes.
+	@staticmethod
+	def version_key(event_id):
+		return 'league_event_version_' + str(event_id)
+
+	def get_version(self):
+		return LeagueEvent.event_version(self.pk)
+
+	@staticmethod
+	def event_version(event_id):
+		key = LeagueEvent.version_key(event_id)
+		version = cache.get(key)
+		if version is None:
+			# A lost version (culled...) must not come back to a value old fragments were cached with.
+			cache.add(key,uuid.uuid4().hex,None)
+			version = cache.get(key)
+		return version
+
+	@staticmethod
+	def bump_version(event_id):
+		if event_id is None:
+			return
+		# A new random version rather than cache.incr: incr isn't atomic in the file cache
+		# and its set would give the key the default timeout.
+		cache.set(LeagueEvent.version_key(event_id),uuid.uuid4().hex,None)
+
+	def get_stats(self):
+		# All the figures of the event, read from its EventSummary row (no query if loaded with select_related('summary')).
+		# They are read once per instance: templates can call the methods below as much as they want.
+		if not hasattr(self,'_stats'):
+			try:
+				summary = self.summary
+			except EventSummary.DoesNotExist:
+				summary = EventSummary.refresh(self)
+			self._stats = summary.get_stats()
+		return self._stats
+
+	def compute_stats(self):
+		# The figures stored in EventSummary, with 3 queries whatever the number of players and divisions.
+		players = self.leagueplayer_set.aggregate(
+			players=Count('pk'),
+			actives=Sum(Case(When(nb_win__gte=self.min_matchs - F('nb_loss'), then=Value(1)), default=Value(0), output_field=IntegerField()))
+		)
+		divisions = self.division_set.annotate(n=Count('leagueplayer')).values_list('n',flat=True)
+		possible_games = 0
+		for n in divisions:
+			possible_games += int(n*(n-1)*self.nb_matchs/2)
+		return {
+			'players': players['players'],
+			'actives': players['actives'] or 0,
+			'divisions': len(divisions),
+			'possible_games': possible_games,
+			'games': self.game_set.count(),
+		}
+
 	def number_players(self):
-		return self.leagueplayer_set.count()
+		return self.get_stats()['players']
 
 	def number_games(self):
-		return self.game_set.count()
+		return self.get_stats()['games']
 
 	def number_divisions(self):
-		return self.division_set.count()
+		return self.get_stats()['divisions']
 
 	def possible_games(self):
-		divisions=self.division_set.all()
-		n=0
-		for division in divisions:
-			n+=division.possible_games()
-		return n
+		return self.get_stats()['possible_games']
 
 	def percent_game_played(self):
 		p= self.possible_games()
 		if p == 0:
 			n=100
 		else:
-			n= round(float(self.number_games()) / float(self.possible_games()) * 100,2)
+			n= round(float(self.number_games()) / float(p) * 100,2)
 		return n
 
 	def get_divisions(self):
@@ -59,15 +122,57 @@ class LeagueEvent(models.Model):
 		return self.leagueplayer_set.all()
 
 	def number_actives_players(self):
-		#not proud of this method. It works thought
-		n=0
-		for player in self.get_players():
-			if player.nb_games()>=self.min_matchs: n+=1
-		return n
+		return self.get_stats()['actives']
 
 	def number_inactives_players(self):
 		return (self.number_players()-self.number_actives_players())
 
+	def rebuild_standings(self,dry_run=False):
+		# Recompute nb_win, nb_loss, score and results of every player of the event from the Game table.
+		# Useful after a game was deleted, a bad sgf was recorded or ppwin/pploss were changed.
+		# Games are read with one query and players are updated with one query per distinct new (nb_win, nb_loss, score).
+		# return the list of changes: [(player, (old nb_win, nb_loss, score), (new nb_win, nb_loss, score))]
+		# and the number of results (Result rows) that changed. With dry_run, nothing is written.
+		players = list(self.leagueplayer_set.all())
+		standings = dict((player.pk,[0,0,Decimal(0)]) for player in players)
+		results = set()
+		games = Game.objects.filter(white__event=self,winner__isnull=False)
+		for pk, white, black, winner in games.values_list('pk','white_id','black_id','winner_id'):
+			loser = black if winner == white else white
+			standings[winner][0] += 1
+			standings[winner][2] += self.ppwin
+			standings[loser][1] += 1
+			standings[loser][2] += self.pploss
+			results.add((winner,loser,pk,True))
+			results.add((loser,winner,pk,False))
+
+		changes = []
+		for player in players:
+			old = (player.nb_win,player.nb_loss,player.score)
+			new = tuple(standings[player.pk])
+			if old != new:
+				changes.append((player,old,new))
+		old_results = set(Result.objects.filter(player__event=self).values_list('player_id','opponent_id','game_id','win'))
+		nb_results = len(results ^ old_results)
+		if dry_run:
+			return (changes,nb_results)
+
+		with transaction.atomic():
+			groups = {}
+			for player, old, new in changes:
+				groups.setdefault(new,[]).append(player.pk)
+			for (nb_win,nb_loss,score), pks in groups.items():
+				LeaguePlayer.objects.filter(pk__in=pks).update(nb_win=nb_win,nb_loss=nb_loss,score=score)
+			if nb_results > 0:
+				Result.objects.filter(player__event=self).delete()
+				Result.objects.bulk_create([Result(player_id=p,opponent_id=o,game_id=g,win=w) for p, o, g, w in results])
+			if changes:
+				UserStats.rebuild([player.user_id for player, old, new in changes])
+		EventSummary.refresh(self)
+		# new version: new crosstables and page fragments.
+		LeagueEvent.bump_version(self.pk)
+		return (changes,nb_results)
+
 
 
 
@@ -82,34 +187,114 @@ class Registry(models.Model):
 	primary_event = models.ForeignKey(LeagueEvent)
 	time_kgs = models.DateTimeField(default=datetime.datetime.now,blank=True) #last time we request kgs
 	kgs_delay = models.SmallIntegerField(default=19) #time between 2 kgs get
+	kgs_rate = models.FloatField(default=1) #max number of kgs requests per second during a scraper run
+	kgs_workers = models.SmallIntegerField(default=4) #number of kgs requests we can wait for at the same time
+	kgs_budget = models.SmallIntegerField(default=240) #max time (seconds) a scraper run can spend requesting kgs
+
+	# The registry is read many times per request and per scraper run.
+	# We load it (and its primary event) once per process and share it. It's reloaded when
+	# a Registry or LeagueEvent is saved, or after REGISTRY_TTL seconds in case another process changed it.
+	# Only the field values of the primary event are shared: each get_primary_event call gets
+	# its own instance, so what a request caches on it (get_stats, summary) doesn't leak to the next ones.
+	REGISTRY_TTL = 60
+	_cached = None
+	_cached_event = None
+	_cached_time = 0
+
+	@staticmethod
+	def get_registry():
+		if Registry._cached is None or time.monotonic() - Registry._cached_time > Registry.REGISTRY_TTL:
+			registry = Registry.objects.get(pk=1)
+			event_fields = [f.attname for f in LeagueEvent._meta.concrete_fields]
+			Registry._cached_event = (event_fields,LeagueEvent.objects.filter(pk=registry.primary_event_id).values_list(*event_fields).get())
+			Registry._cached = registry
+			Registry._cached_time = time.monotonic()
+		return Registry._cached
+
+	@staticmethod
+	def clear_cache():
+		Registry._cached = None
 
 	@staticmethod
 	def get_primary_event():
-		r=Registry.objects.get(pk=1)
-		return r.primary_event
+		registry = Registry.get_registry()
+		field_names, values = Registry._cached_event
+		return LeagueEvent.from_db(registry._state.db,field_names,values)
 
 	@staticmethod
 	def get_time_kgs():
-		r=Registry.objects.get(pk=1)
-		return r.time_kgs
+		return Registry.get_registry().time_kgs
 
 	@staticmethod
 	def get_kgs_delay():
-		r=Registry.objects.get(pk=1)
-		return r.kgs_delay
+		return Registry.get_registry().kgs_delay
+
+	@staticmethod
+	def get_kgs_settings():
+		# rate, workers and budget of the concurrent kgs fetcher
+		r=Registry.get_registry()
+		return {'rate': r.kgs_rate, 'workers': r.kgs_workers, 'budget': r.kgs_budget}
 
 	@staticmethod
 	def set_time_kgs(time):
-		r=Registry.objects.get(pk=1)
-		r.time_kgs = time
-		r.save()
+		# update() doesn't send post_save: we keep the cached registry and update it
+		Registry.objects.filter(pk=1).update(time_kgs=time)
+		Registry.get_registry().time_kgs = time
+
+
+class EventSummary(models.Model):
+	# Precomputed figures of an event so that listing events (archives) is a single query.
+	# Refreshed when players join, games are created, rollover happens and standings are rebuilt.
+	# Other changes to events, players, divisions and games delete it through the receivers below
+	# and LeagueEvent.get_stats rebuilds it when needed.
+	# backfill_event_summaries command creates the missing rows.
+	event = models.OneToOneField('LeagueEvent', related_name='summary')
+	players = models.PositiveIntegerField(default=0)
+	actives = models.PositiveIntegerField(default=0)
+	divisions = models.PositiveIntegerField(default=0)
+	possible_games = models.PositiveIntegerField(default=0)
+	games = models.PositiveIntegerField(default=0)
+	updated = models.DateTimeField(auto_now=True)
+
+	def __str__(self):
+		return str(self.event)
+
+	def get_stats(self):
+		return {
+			'players': self.players,
+			'actives': self.actives,
+			'divisions': self.divisions,
+			'possible_games': self.possible_games,
+			'games': self.games,
+		}
+
+	@staticmethod
+	def refresh(event):
+		# recompute the summary of an event. event can be an event or its pk.
+		if not isinstance(event,LeagueEvent):
+			event = LeagueEvent.objects.filter(pk=event).first()
+			if event is None:
+				return None
+		summary, created = EventSummary.objects.update_or_create(event=event,defaults=event.compute_stats())
+		# the event can be the shared primary event of Registry: make it see the new figures.
+		event.summary = summary
+		if hasattr(event,'_stats'):
+			del event._stats
+		return summary
+
+
+@receiver(post_save, sender=Registry)
+@receiver(post_save, sender=LeagueEvent)
+@receiver(post_delete, sender=LeagueEvent)
+def clear_registry_cache(sender, **kwargs):
+	Registry.clear_cache()
 
 
 class Sgf(models.Model):
 	#when a sgf is added, we 1st add just the urlto then we add the rest with parse
 	# this is to prevent many kgs get request in short time
-	sgf_text = models.TextField(default='sgf')
-	urlto = models.URLField(default='http://')
+	sgf_text = CompressedTextField(default='sgf') #loaded for nothing by listings: defer it when you don't need it
+	urlto = models.URLField(default='http://',db_index=True)
 	wplayer = models.CharField(max_length=200,default='?')
 	bplayer = models.CharField(max_length=200,default='?')
 	place = models.CharField(max_length=200,default='?')
@@ -124,8 +309,9 @@ class Sgf(models.Model):
 	game_type = models.CharField(max_length=20,default='Free')
 	message = models.CharField(max_length=100,default='nothing',blank=True)
 	number_moves = models.SmallIntegerField(default=100)
-	p_status = models.SmallIntegerField(default=1)
-	check_code = models.CharField(max_length=100,default='nothing',blank=True)
+	p_status = models.SmallIntegerField(default=1,db_index=True)
+	check_code = models.CharField(max_length=100,default='nothing',blank=True,db_index=True)
+	sgf_hash = models.CharField(max_length=40,default='',blank=True,editable=False) #sha1 of sgf_text, set on save. It's the etag of the raw sgf view
 	# status of the sgf:0 already checked
 	#					1 require checking, sgf added from kgs archive link
 	#					2 require checking with priority,sgf added/changed by admin
@@ -133,15 +319,27 @@ class Sgf(models.Model):
 	def __str__(self):
 		return self.wplayer + ' vs ' + self.bplayer
 
+	@staticmethod
+	def hash_text(sgf_text):
+		return hashlib.sha1(sgf_text.encode('utf-8')).hexdigest()
+
+	def save(self,*args,**kwargs):
+		# sgf_text is not in __dict__ when it was deferred and not read: it didn't change then.
+		if 'sgf_text' in self.__dict__:
+			self.sgf_hash = Sgf.hash_text(self.sgf_text)
+		super(Sgf,self).save(*args,**kwargs)
 
-	def parse(self):
+
+	def parse(self,sgf_text=None):
 		#parse one sgf :
 		#check the p_status, and populate the rows
+		# sgf_text can be provided if it was already downloaded (see scraper)
 		if self.p_status == 0:
 			return
 		if self.p_status == 1: # we only have the urlto and need a kgs request
-			r = requests.get(self.urlto)
-			self.sgf_text = r.text
+			if sgf_text is None:
+				sgf_text = utils.download_sgf(self.urlto)
+			self.sgf_text = sgf_text
 		prop = utils.parse_sgf_string(self.sgf_text)
 		#prop['time'] = int(prop['time'])
 		for k, v in prop.items(): setattr(self, k, v)
@@ -160,14 +358,12 @@ class Sgf(models.Model):
 		if self.game_type == 'review': (b,m) = (False,m+' review gametype')
 		if not('#OSR' in self.sgf_text or '#osr' in self.sgf_text): (b,m)= (False,m+'; Tag missing')
 		event = Registry.get_primary_event()
-		wplayer = LeaguePlayer.objects.filter(kgs_username__iexact = self.wplayer, event = event).first()
-		bplayer = LeaguePlayer.objects.filter(kgs_username__iexact = self.bplayer, event = event).first()
+		wplayer = LeaguePlayer.objects.filter(kgs_username_lower = self.wplayer.lower(), event = event).first()
+		bplayer = LeaguePlayer.objects.filter(kgs_username_lower = self.bplayer.lower(), event = event).first()
 		if wplayer != None and bplayer != None :
 			if	wplayer.division != bplayer.division: (b,m) = (False,m+'; players not in same division')
-			w_results = wplayer.get_results()
-			if self.bplayer in w_results:
-				if len(w_results[self.bplayer]) >= event.nb_matchs:
-					(b,m) = (False,m+'; max number of games')
+			if wplayer.nb_games_against(bplayer) >= event.nb_matchs:
+				(b,m) = (False,m+'; max number of games')
 		else : (b,m) = (False,m+'; One of the players is not a league player')
 
 		if not utils.check_byoyomi(self.byo):
@@ -186,6 +382,218 @@ class Sgf(models.Model):
 
 
 
+class ScraperTask(models.Model):
+	# The scraper work queue: one task per sgf or league player waiting to be scraped.
+	# p_status of Sgf and LeaguePlayer still say what has to be done: refill() queues them.
+	# A worker claims tasks with a lease. Until the lease expires, no other worker can claim them,
+	# so several scraper processes can run at the same time without scraping anything twice.
+	# A task is deleted once done. If the worker fails, its lease expires and the task is claimed again.
+	sgf = models.OneToOneField('Sgf',blank=True,null=True)
+	player = models.OneToOneField('LeaguePlayer',blank=True,null=True)
+	priority = models.SmallIntegerField(default=0)
+	# priority: 2 sgf added/changed by admin
+	#			1 sgf from kgs archive
+	#			0 player to check
+	lease_until = models.DateTimeField(blank=True,null=True,db_index=True)
+	worker = models.CharField(max_length=32,default='',blank=True)
+
+	class Meta:
+		ordering = ['-priority','pk']
+
+	def __str__(self):
+		if self.sgf_id is not None:
+			return 'sgf ' + str(self.sgf_id)
+		return 'player ' + str(self.player_id)
+
+	@staticmethod
+	def refill(event):
+		# queue the sgfs and the players of event that need scraping and are not queued yet.
+		tasks = []
+		for pk, p_status in Sgf.objects.filter(p_status__gt=0,scrapertask__isnull=True).values_list('pk','p_status'):
+			tasks.append(ScraperTask(sgf_id=pk,priority=p_status))
+		for pk in LeaguePlayer.objects.filter(event=event,p_status__gt=0,scrapertask__isnull=True).values_list('pk',flat=True):
+			tasks.append(ScraperTask(player_id=pk,priority=0))
+		if len(tasks) > 0:
+			try:
+				with transaction.atomic():
+					ScraperTask.objects.bulk_create(tasks)
+			except IntegrityError:
+				pass # another worker queued them in the meantime
+		# an admin could have changed a sgf that was already queued
+		ScraperTask.objects.filter(sgf__p_status=2,priority__lt=2).update(priority=2)
+
+	@staticmethod
+	def claim(worker,kind,n,lease):
+		# claim up to n free tasks of kind ('sgf' or 'player') for lease seconds. Highest priority first.
+		# The update only takes tasks that are still free: a task claimed by someone else in the meantime is skipped.
+		now = timezone.now()
+		lease_until = now + datetime.timedelta(seconds=lease)
+		free = Q(lease_until__isnull=True)|Q(lease_until__lt=now)
+		tasks = ScraperTask.objects.filter(**{kind+'__isnull':False})
+		pks = list(tasks.filter(free).values_list('pk',flat=True)[:n])
+		if len(pks) == 0:
+			return []
+		ScraperTask.objects.filter(free,pk__in=pks).update(lease_until=lease_until,worker=worker)
+		tasks = tasks.filter(pk__in=pks,worker=worker,lease_until=lease_until)
+		if kind == 'sgf':
+			return list(tasks.select_related('sgf').defer('sgf__sgf_text'))
+		return list(tasks.select_related('player__user','player__event'))
+
+	def done(self):
+		ScraperTask.objects.filter(pk=self.pk).delete()
+
+
+class ScraperRun(models.Model):
+	# What one run of the scraper did. Read by the scraper dashboard and metrics views.
+	start_time = models.DateTimeField(default=timezone.now)
+	duration = models.FloatField(default=0) #seconds
+	action = models.CharField(max_length=20,default='wait')
+	# action: wait: kgs delay not over yet
+	#		  idle: nothing to do
+	#		  sgfs, players or sgfs+players: what we scraped
+	kgs_requests = models.IntegerField(default=0)
+	kgs_time = models.FloatField(default=0) #time spent waiting for kgs answers, all threads added
+	parse_time = models.FloatField(default=0) #time spent parsing sgfs
+	sgfs_scraped = models.IntegerField(default=0)
+	players_checked = models.IntegerField(default=0)
+	games_created = models.IntegerField(default=0)
+	games_rejected = models.IntegerField(default=0)
+	http_status = models.TextField(default='{}') #json {status: number of kgs answers}. status is 'error' if we had no answer
+	rejections = models.TextField(default='{}') #json {reason: number of sgfs rejected}
+
+	KEEP_DAYS = 7
+
+	class Meta:
+		ordering = ['-start_time']
+
+	def __str__(self):
+		return self.action + ' ' + str(self.start_time)
+
+	def get_http_status(self):
+		return json.loads(self.http_status)
+
+	def get_rejections(self):
+		return json.loads(self.rejections)
+
+	def add_phase(self,phase):
+		if self.action in ('wait','idle'):
+			self.action = phase
+		elif phase not in self.action.split('+'):
+			self.action += '+' + phase
+
+	def reject(self,reason):
+		# reason can be a check_validity message: '; Tag missing; main time'
+		self.games_rejected += 1
+		rejections = self.get_rejections()
+		for r in reason.split(';'):
+			r = r.strip()
+			if r:
+				rejections[r] = rejections.get(r,0) + 1
+		self.rejections = json.dumps(rejections)
+
+	def finish(self,start,kgs_stats):
+		# save the run with the kgs figures collected by utils.kgs_stats and drop old runs
+		self.duration = time.monotonic() - start
+		self.kgs_requests = kgs_stats['requests']
+		self.kgs_time = kgs_stats['time']
+		self.http_status = json.dumps(kgs_stats['status'])
+		self.save()
+		ScraperRun.objects.filter(start_time__lt=timezone.now() - datetime.timedelta(days=ScraperRun.KEEP_DAYS)).delete()
+
+	@staticmethod
+	def get_backlog():
+		# what the scraper still has to do
+		sgfs = dict(Sgf.objects.filter(p_status__gt=0).values_list('p_status').annotate(n=Count('pk')).order_by())
+		event = Registry.get_primary_event()
+		return {
+			'sgfs': sgfs.get(1,0),
+			'admin_sgfs': sgfs.get(2,0),
+			'players': LeaguePlayer.objects.filter(event=event,p_status__gt=0).count(),
+		}
+
+	@staticmethod
+	def get_totals(since):
+		# sum of the runs since a date
+		runs = ScraperRun.objects.filter(start_time__gte=since)
+		totals = runs.aggregate(
+			runs=Count('pk'),
+			duration=Sum('duration'),
+			kgs_requests=Sum('kgs_requests'),
+			kgs_time=Sum('kgs_time'),
+			parse_time=Sum('parse_time'),
+			sgfs_scraped=Sum('sgfs_scraped'),
+			players_checked=Sum('players_checked'),
+			games_created=Sum('games_created'),
+			games_rejected=Sum('games_rejected'),
+		)
+		for k, v in totals.items():
+			if v is None:
+				totals[k] = 0
+		http_status = {}
+		rejections = {}
+		for status, reasons in runs.values_list('http_status','rejections'):
+			for k, v in json.loads(status).items():
+				http_status[k] = http_status.get(k,0) + v
+			for k, v in json.loads(reasons).items():
+				rejections[k] = rejections.get(k,0) + v
+		totals['http_status'] = http_status
+		totals['rejections'] = rejections
+		return totals
+
+
+class SgfReparseJob(models.Model):
+	# Reparse all sgfs from db and update their check_code (see update_all_sgf view).
+	# The job is run by SgfReparseCronJob chunk by chunk and can resume after last_pk.
+	start_time = models.DateTimeField(auto_now_add=True)
+	last_pk = models.IntegerField(default=0) #last sgf reparsed
+	total = models.IntegerField(default=0)
+	done = models.IntegerField(default=0)
+	updated = models.IntegerField(default=0)
+	status = models.SmallIntegerField(default=1)
+	# status of the job: 0 finished
+	#					1 running
+
+	CHUNK_SIZE = 500
+
+	class Meta:
+		ordering = ['-start_time']
+
+	def __str__(self):
+		return 'sgf reparse ' + str(self.done) + '/' + str(self.total)
+
+	@staticmethod
+	def start():
+		# start a new job unless one is already running. return the running job
+		job = SgfReparseJob.objects.filter(status=1).first()
+		if job is None:
+			job = SgfReparseJob.objects.create(total=Sgf.objects.count())
+		return job
+
+	def run(self,deadline):
+		# reparse sgfs chunk by chunk in a process pool until deadline (a time.monotonic() value).
+		# only changed check_codes are written back, with one update per chunk.
+		# one keyset query per chunk: iterator() would still fetch every row at once on sqlite.
+		with multiprocessing.Pool() as pool:
+			while time.monotonic() < deadline:
+				sgfs = Sgf.objects.filter(pk__gt=self.last_pk).order_by('pk').only('pk','sgf_text','check_code')
+				chunk = list(sgfs[:SgfReparseJob.CHUNK_SIZE])
+				if len(chunk) == 0:
+					self.status = 0
+					break
+				props = pool.map(utils.parse_sgf_string,[sgf.sgf_text for sgf in chunk])
+				changed = dict((sgf.pk,prop['check_code']) for sgf, prop in zip(chunk,props) if prop['check_code'] != sgf.check_code)
+				with transaction.atomic():
+					if len(changed) > 0:
+						codes = Case(*[When(pk=pk, then=Value(code)) for pk, code in changed.items()])
+						Sgf.objects.filter(pk__in=changed.keys()).update(check_code=codes)
+					self.last_pk = chunk[-1].pk
+					self.done += len(chunk)
+					self.updated += len(changed)
+					self.save()
+		self.save()
+		return self
+
+
 class User(AbstractUser):
 	kgs_username = models.CharField(max_length=20)
 
@@ -200,6 +608,7 @@ class User(AbstractUser):
 			player.kgs_username = self.kgs_username
 			player.user = self
 			player.save()
+			UserStats.rebuild([self.pk])
 			return True
 
 	def is_in_primary_event(self):
@@ -216,30 +625,99 @@ class User(AbstractUser):
 	def user_is_league_member(self):
 		return self.groups.filter(name='league_member').exists()
 
+	def get_stats(self):
+		# the precomputed UserStats of this user. Use select_related('stats') when listing users.
+		# A user that never joined a league has no stats row: we return an empty one.
+		try:
+			return self.stats
+		except UserStats.DoesNotExist:
+			return UserStats(user=self)
+
 	def nb_games(self):
-		players = self.leagueplayer_set.all()
-		n = 0
-		for player in players:
-			n += player.nb_games()
-		return n
+		return self.get_stats().nb_games
 
 	def nb_players(self):
-		return self.leagueplayer_set.all().count()
+		return self.get_stats().nb_events
 
 	def nb_win(self):
-		players = self.leagueplayer_set.all()
-		n = 0
-		for player in players:
-			n += player.nb_win
-		return n
+		return self.get_stats().nb_win
 
 	def nb_loss(self):
-		players = self.leagueplayer_set.all()
-		n = 0
-		for player in players:
-			n += player.nb_loss
-		return n
+		return self.get_stats().nb_loss
 
+	def last_active(self):
+		return self.get_stats().last_active
+
+
+class UserStats(models.Model):
+	# Career figures of a user over all the events, kept up to date by Game.create_game.
+	# join_event and rollover call rebuild for the users they touch.
+	# If they ever get wrong, rebuild_user_stats command recomputes them from LeaguePlayer and Game tables.
+	user = models.OneToOneField('User', related_name='stats')
+	nb_games = models.PositiveIntegerField(default=0)
+	nb_win = models.PositiveIntegerField(default=0)
+	nb_loss = models.PositiveIntegerField(default=0)
+	nb_events = models.PositiveIntegerField(default=0)
+	last_active = models.DateTimeField(blank=True,null=True)
+
+	def __str__(self):
+		return str(self.user)
+
+	@staticmethod
+	def record_game(winner_id,loser_id,date):
+		# Count a new game for both users. Called inside create_game transaction.
+		# One update per user row: the counters and last_active together.
+		if date is None:
+			last_active = F('last_active')
+		else:
+			last_active = Case(
+				When(Q(last_active__lt=date)|Q(last_active__isnull=True), then=Value(date)),
+				default=F('last_active'),
+				output_field=models.DateTimeField()
+			)
+		for user_id, win in ((winner_id,1),(loser_id,0)):
+			updated = UserStats.objects.filter(user_id=user_id).update(
+				nb_games=F('nb_games')+1,
+				nb_win=F('nb_win')+win,
+				nb_loss=F('nb_loss')+1-win,
+				last_active=last_active
+			)
+			if updated == 0:
+				# no stats yet: rebuild sees the game we just created.
+				UserStats.rebuild([user_id])
+
+	@staticmethod
+	def rebuild(user_ids=None):
+		# Recompute the stats of some users (all users having played in a league if None).
+		# One aggregate query on LeaguePlayer, two on Game, whatever the number of users.
+		players = LeaguePlayer.objects.all()
+		if user_ids is not None:
+			players = players.filter(user_id__in=user_ids)
+		stats = {}
+		for row in players.values('user_id').annotate(events=Count('pk'),wins=Sum('nb_win'),losses=Sum('nb_loss')):
+			stats[row['user_id']] = UserStats(
+				user_id=row['user_id'],
+				nb_games=row['wins']+row['losses'],
+				nb_win=row['wins'],
+				nb_loss=row['losses'],
+				nb_events=row['events'],
+			)
+		for color in ('white','black'):
+			games = Game.objects.all()
+			if user_ids is not None:
+				games = games.filter(**{color+'__user_id__in':user_ids})
+			for row in games.values(color+'__user_id').annotate(last=Max('sgf__date')):
+				user_stats = stats.get(row[color+'__user_id'])
+				if user_stats is not None and row['last'] is not None:
+					if user_stats.last_active is None or user_stats.last_active < row['last']:
+						user_stats.last_active = row['last']
+		with transaction.atomic():
+			old = UserStats.objects.all()
+			if user_ids is not None:
+				old = old.filter(user_id__in=user_ids)
+			old.delete()
+			UserStats.objects.bulk_create(stats.values())
+		return len(stats)
 
 
 def is_league_admin(user):
@@ -271,11 +749,50 @@ class Division(models.Model):
 		n = self.number_players()
 		return int(n*(n-1)*self.league_event.nb_matchs/2)
 
+	# crosstables of old versions are never read again: let them expire.
+	CROSSTABLE_TTL = 24*3600
+
+	@staticmethod
+	def crosstable_key(division_id,version):
+		return 'league_crosstable_' + str(division_id) + '_' + str(version)
+
+	def get_results_matrix(self):
+		# All the results of the division from the Game table:
+		#  {(player.pk, opponent.pk):[(game.pk, r),...],...} with r: 1 for win, 0 for loss
+		# It's cached under the version of the event: any change to a game, player or division
+		# of the event gives a new key (see LeagueEvent.get_version).
+		key = Division.crosstable_key(self.pk,LeagueEvent.event_version(self.league_event_id))
+		matrix = cache.get(key)
+		if matrix is None:
+			matrix = {}
+			games = Game.objects.filter(white__division=self,black__division=self,winner__isnull=False)
+			for pk, white, black, winner in games.order_by('pk').values_list('pk','white_id','black_id','winner_id'):
+				matrix.setdefault((white,black),[]).append((pk,int(winner == white)))
+				matrix.setdefault((black,white),[]).append((pk,int(winner == black)))
+			cache.set(key,matrix,Division.CROSSTABLE_TTL)
+		return matrix
+
+	def get_crosstable(self,players):
+		# rows of the results table, in the order of players:
+		#  [{'player':player,'cells':[results against each player, None for himself]},...]
+		matrix = self.get_results_matrix()
+		rows = []
+		for player in players:
+			cells = []
+			for opponent in players:
+				if opponent.pk == player.pk:
+					cells.append(None)
+				else:
+					cells.append(matrix.get((player.pk,opponent.pk),[]))
+			rows.append({'player':player,'cells':cells})
+		return rows
+
 
 
 class LeaguePlayer(models.Model):
 	user = models.ForeignKey('User')
 	kgs_username = models.CharField(max_length=20,default='') #it's redundent with user, but let say a user change his kgs_username...
+	kgs_username_lower = models.CharField(max_length=20,default='',editable=False) #lowercase kgs_username, set on save. Use it instead of kgs_username__iexact
 	event = models.ForeignKey('LeagueEvent')
 	division = models.ForeignKey('Division')
 	nb_win = models.SmallIntegerField(default=0)
@@ -283,44 +800,50 @@ class LeaguePlayer(models.Model):
 	score = models.DecimalField(default=0, max_digits =4, decimal_places=1)
 	results = models.CharField(max_length=2000,default='{}',blank=True)
 	p_status = models.SmallIntegerField(default=0)
-#Note that results is a dirty string formated as a dict.
-# we will eval() to get it and str() to store.
-# results is formated as:
-#  {'opponent1':[{'id':game1.pk, 'r':1/0},{'id':game2.pk, 'r':1/0},...],'opponent2':[...]}
-# r: 1 for win, 0 for loss
+	kgs_etag = models.CharField(max_length=100,default='',blank=True) #validators of the last kgs archive page we got
+	kgs_last_modified = models.CharField(max_length=40,default='',blank=True) #they make the next request conditional
+# Note: results is a legacy dirty string formated as a dict. Games results are now Result rows.
+# It's only read by the convert_results command and will be dropped once every db has been converted.
+	class Meta:
+		index_together = [('kgs_username_lower','event'),('kgs_username_lower','division')]
+
 	def __str__(self):
 		return self.kgs_username
 
+	SCRAPER_FIELDS = ['p_status','kgs_etag','kgs_last_modified']
+
+	def save(self,*args,**kwargs):
+		self.kgs_username_lower = self.kgs_username.lower()
+		super(LeaguePlayer,self).save(*args,**kwargs)
+
 	def get_results(self):
-		return eval(self.results)
+		# return the results of the player formated as:
+		#  {'opponent1':[{'id':game1.pk, 'r':1/0},{'id':game2.pk, 'r':1/0},...],'opponent2':[...]}
+		# r: 1 for win, 0 for loss
+		results = {}
+		for opponent, game_id, win in self.player_results.values_list('opponent__kgs_username','game_id','win'):
+			results.setdefault(opponent,[]).append({'id':game_id, 'r':int(win)})
+		return results
+
+	def nb_games_against(self,opponent):
+		return self.player_results.filter(opponent=opponent).count()
 
 	def score_victory(self,opponent,game_id):
 		#score a victory for self again opponent (a LeaguePlayer)
-		# update score, nb_win and results
+		# update score, nb_win and results.
+		# The counters are updated by the db (F expressions): concurrent scorings can't overwrite each other.
+		LeaguePlayer.objects.filter(pk=self.pk).update(nb_win=F('nb_win')+1,score=F('score')+self.event.ppwin)
 		self.nb_win +=  1
 		self.score += self.event.ppwin
-		dict_results = eval(self.results)
-		opponent=opponent.kgs_username
-		if opponent in dict_results :
-			 dict_results[opponent].append({'id':game_id, 'r':1})
-		else : dict_results[opponent]= [{'id':game_id, 'r':1}]
-		str_results = str(dict_results)
-		self.results = str_results
-		self.save()
+		Result.objects.create(player=self,opponent=opponent,game_id=game_id,win=True)
 
 	def score_defeat(self,opponent,game_id):
+		LeaguePlayer.objects.filter(pk=self.pk).update(nb_loss=F('nb_loss')+1,score=F('score')+self.event.pploss)
 		self.nb_loss +=  1
 		self.score += self.event.pploss
-		dict_results = eval(self.results)
-		opponent=opponent.kgs_username
-		if opponent in dict_results :
-			dict_results[opponent].append({'id':game_id, 'r':0})
-		else : dict_results[opponent]=[{'id':game_id, 'r':0}]
-		str_results = str(dict_results)
-		self.results = str_results
-		self.save()
+		Result.objects.create(player=self,opponent=opponent,game_id=game_id,win=False)
 
-	def check_player(self):
+	def check_player(self,list_urlto_games=None,asked=False):
 		# check if a player have play new games:
 		# get a list of games from kgs (only 1 request to kgs)
 		# for each game we check if it's already in db (comparing urlto)
@@ -329,18 +852,30 @@ class LeaguePlayer(models.Model):
 		# if no do nothing
 		# we can't get more info on the game yet cause we need the sgf datas for that.
 		# So that would imply one additional kgs request per game in very short time.
+		# If kgs was already asked (see scraper), asked is True and list_urlto_games is its answer.
+		# If it's None, the archive page didn't change since our last check: nothing to do.
 
+		if not asked:
+			list_urlto_games=self.ask_kgs()
 		self.p_status =0
-		self.save()
-		kgs_username = self.user.kgs_username
-		year = self.event.get_year()
-		month = self.event.get_month()
-		list_urlto_games=utils.ask_kgs(kgs_username,year,month)
+		# only the scraper fields: saving them doesn't change the event pages (see bump_event_version)
+		self.save(update_fields=LeaguePlayer.SCRAPER_FIELDS)
+		if list_urlto_games is None:
+			return
 		#list_urlto_games=[{url:'url',game_type:'game_type'},{...},...]
+		# We load the urls we already know and the usernames of the division once,
+		# compare in memory and insert the new sgfs all at once.
+		urls = [d['url'] for d in list_urlto_games]
+		if len(urls) == 0:
+			return
+		known_urls = set(Sgf.objects.filter(urlto__in=urls).values_list('urlto',flat=True))
+		division_usernames = set(LeaguePlayer.objects.filter(division=self.division_id).values_list('kgs_username_lower',flat=True))
+		sgfs = []
 		for d in list_urlto_games:
 			url=d['url']
 			game_type=d['game_type']
-			if  not Sgf.objects.filter(urlto = url).exists():
+			if url not in known_urls:
+				known_urls.add(url)
 				#check if both players are in the league
 				players = utils.extract_players_from_url(url)
 				#no need to check the self to be in the league
@@ -348,20 +883,34 @@ class LeaguePlayer(models.Model):
 					player = players['black']
 				else:
 					player = players['white']
-				if LeaguePlayer.objects.filter(kgs_username__iexact=player,division=self.division).exists():
+				if player.lower() in division_usernames:
 					sgf = Sgf()
 					sgf.wplayer = players['white']
 					sgf.bplayer = players['black']
 					sgf.urlto = url
 					sgf.p_status = 1
 					sgf.game_type = game_type
-					sgf.save()
+					sgfs.append(sgf)
+		Sgf.objects.bulk_create(sgfs)
+
+	def ask_kgs(self):
+		# get the list of games of this player for the event month from kgs
+		# The scraper calls it from its fetching threads: user and event must already be loaded (select_related)
+		# The request is conditional: return None if the page didn't change. New validators are saved by check_player.
+		validators = {'etag':self.kgs_etag, 'last_modified':self.kgs_last_modified}
+		list_urlto_games = utils.ask_kgs(self.user.kgs_username,self.event.get_year(),self.event.get_month(),validators)
+		self.kgs_etag = validators['etag']
+		self.kgs_last_modified = validators['last_modified']
+		return list_urlto_games
 
 	def nb_games(self):
 		return(self.nb_win+self.nb_loss)
 
-	def is_active(self):
-		return self.nb_games() >= self.event.min_matchs
+	def is_active(self,min_matchs=None):
+		# min_matchs can be given when we already have the event, saving a query per player.
+		if min_matchs is None:
+			min_matchs = self.event.min_matchs
+		return self.nb_games() >= min_matchs
 
 
 class Game(models.Model):
@@ -382,39 +931,91 @@ class Game(models.Model):
 		# return true if successfully create a game, false otherwise
 
 		#check if we already got a game with this sgf
-		if Game.objects.filter(sgf=sgf).exists() or not(sgf.league_valid):
+		if not(sgf.league_valid) or Game.objects.filter(sgf=sgf).exists():
+			return False
+		event=Registry.get_primary_event()
+		# both players with one query. Each of them must be exactly once in the event
+		whites = []
+		blacks = []
+		for player in LeaguePlayer.objects.filter(event=event,kgs_username_lower__in=[sgf.wplayer.lower(),sgf.bplayer.lower()]):
+			if player.kgs_username_lower == sgf.wplayer.lower():
+				whites.append(player)
+			if player.kgs_username_lower == sgf.bplayer.lower():
+				blacks.append(player)
+		if len(whites) != 1 or len(blacks) != 1:
 			return False
+		white = whites[0]
+		black = blacks[0]
+		white.event = event
+		black.event = event
+		#the winner field and the results :
+		if sgf.result.find('B+') == 0:
+			(winner,loser) = (black,white)
+		elif sgf.result.find('W+') == 0:
+			(winner,loser) = (white,black)
 		else:
-			event=Registry.get_primary_event()
-			game = Game()
-			game.event = event
-			game.sgf = sgf
-			game.save() #we need to save it to be able to add a OnetoOnefield
-			whites = LeaguePlayer.objects.filter(kgs_username__iexact = sgf.wplayer).filter(event=event)
-			if len(whites) == 1:
-				 game.white = whites.first()
-			else :
-				game.delete()
-				return False
-			blacks = LeaguePlayer.objects.filter(kgs_username__iexact = sgf.bplayer).filter(event=event)
-			if len(blacks) == 1:
-				 game.black = blacks.first()
-			else :
-				game.delete()
-				return False
-			game.save()
-			#add the winner field and score the results :
-			if sgf.result.find('B+') == 0:
-				game.winner = blacks.first()
-				game.winner.score_victory(game.white,game.pk)
-				game.white.score_defeat(game.black,game.pk)
-			elif sgf.result.find('W+') == 0:
-				game.winner = whites.first()
-				game.winner.score_victory(game.black,game.pk)
-				game.black.score_defeat(game.white,game.pk)
-
-			else:
-				game.delete()
-				return False
-			game.save()
-			return True
+			return False
+		# The game is saved once, each player row is updated once, all or nothing.
+		# If another worker recorded this sgf meanwhile, the sgf unique constraint rolls us back.
+		try:
+			with transaction.atomic():
+				game = Game.objects.create(sgf=sgf,event=event,white=white,black=black,winner=winner)
+				winner.score_victory(loser,game.pk)
+				loser.score_defeat(winner,game.pk)
+				UserStats.record_game(winner.user_id,loser.user_id,sgf.date)
+		except IntegrityError:
+			return False
+		EventSummary.refresh(event)
+		return True
+
+
+class Result(models.Model):
+	# One row per player and per game he played. (player, opponent) is indexed
+	# so head to head lookups don't have to read the whole history of a player.
+	player = models.ForeignKey('LeaguePlayer', related_name='player_results')
+	opponent = models.ForeignKey('LeaguePlayer', related_name='opponent_results')
+	game = models.ForeignKey('Game')
+	win = models.BooleanField(default=False)
+
+	class Meta:
+		index_together = [('player','opponent')]
+		ordering = ['game']
+
+	def __str__(self):
+		return self.player.kgs_username + (' won ' if self.win else ' lost ') + 'against ' + self.opponent.kgs_username
+
+
+def bump_event_version(event_id):
+	# Bump after commit: a page rendered before the commit would be cached with the new version.
+	transaction.on_commit(lambda: LeagueEvent.bump_version(event_id))
+
+
+def event_changed(event_id):
+	# The figures and the pages of the event are stale: both go together.
+	# The summary is rebuilt by the next LeagueEvent.get_stats call.
+	# We don't refresh it here: these deletions can be part of the event deletion itself.
+	EventSummary.objects.filter(event_id=event_id).delete()
+	bump_event_version(event_id)
+
+
+@receiver(post_save, sender=LeaguePlayer)
+def player_saved(sender, instance, update_fields=None, **kwargs):
+	# The scraper saves players all the time, but only its own fields: they don't change the event.
+	if update_fields is not None and set(update_fields) <= set(LeaguePlayer.SCRAPER_FIELDS):
+		return
+	event_changed(instance.event_id)
+
+
+@receiver(post_save, sender=LeagueEvent)
+def event_saved(sender, instance, **kwargs):
+	# name, dates... are shown in the event pages, nb_matchs and min_matchs change possible_games and actives
+	event_changed(instance.pk)
+
+
+@receiver(post_delete, sender=LeaguePlayer)
+@receiver(post_save, sender=Division)
+@receiver(post_delete, sender=Division)
+@receiver(post_save, sender=Game)
+@receiver(post_delete, sender=Game)
+def event_content_changed(sender, instance, **kwargs):
+	event_changed(instance.league_event_id if sender is Division else instance.event_id)
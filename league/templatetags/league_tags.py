@@ -4,6 +4,18 @@ from django.utils.safestring import mark_safe
 
 register = template.Library()
 
+def results_html(results):
+	# results is a list of (game.pk, r) with r: 1 for win, 0 for loss
+	html=""
+	for game_id, r in results:
+		html += '<a href="/wgo/game/' + str(game_id) + '"target="wgo_iframe">'
+		if r==1 :
+			html += '<i class="fa fa-circle-o" aria-hidden="true" style="color:green"></i></a>'
+		#will be glyphicon glyphicon-ok-circle or fontawesome thing
+		else :
+			html += '<i class="fa fa-circle" aria-hidden="true" style="color:blue"></i></a>'
+	return html
+
 @register.simple_tag(takes_context=True)
 def html_one_result(context):
 	# note the use of takes_context = true.
@@ -14,18 +26,14 @@ def html_one_result(context):
 	opponent_kgs=opponent.kgs_username
 	html=""
 	if opponent_kgs in results:
-		result=results[opponent_kgs]
-		for game in result:
-			#here, game['id'] would get you the id of the game to add a link
-			html += '<a href="/wgo/game/' + str(game['id']) + '"target="wgo_iframe">'
-			if game['r']==1 :
-				 html += '<i class="fa fa-circle-o" aria-hidden="true" style="color:green"></i></a>'
-			#will be glyphicon glyphicon-ok-circle or fontawesome thing
-			else :
-			 html += '<i class="fa fa-circle" aria-hidden="true" style="color:blue"></i></a>'
-
+		html = results_html([(game['id'],game['r']) for game in results[opponent_kgs]])
 	return mark_safe(html)
 
+@register.filter
+def html_results(results):
+	# render one cell of a division crosstable (see Division.get_crosstable)
+	return mark_safe(results_html(results))
+
 @register.filter
 def nb_games(player):
 	n = player.nb_win + player.nb_loss
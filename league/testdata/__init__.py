@@ -0,0 +1,5 @@
+'''Recorded pages and files used by the league tests and benchmark commands.'''
+import os
+
+# gameArchives.jsp pages recorded from gokgs.com
+KGS_ARCHIVES_DIR = os.path.join(os.path.dirname(__file__), 'kgs_archives')
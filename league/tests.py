@@ -1,3 +1,121 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase, RequestFactory
+from django.db import connection
+from unittest import skipUnless, mock
+from .models import Sgf, LeaguePlayer
+from . import utils
+from .views import games_page_start
+from .testdata import KGS_ARCHIVES_DIR
+import os
+import requests
 
-# Create your tests here.
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is sqlite only')
+class IndexUsageTests(TestCase):
+	'''The scraper lookups must use the indexes, not scan whole tables.'''
+
+	def query_plan(self, queryset):
+		sql, params = queryset.query.sql_with_params()
+		with connection.cursor() as cursor:
+			cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+			return ' '.join(row[-1] for row in cursor.fetchall())
+
+	def assertUsesIndex(self, queryset, column):
+		plan = self.query_plan(queryset)
+		self.assertIn('INDEX', plan)
+		self.assertIn('(' + column + '=', plan)
+
+	def test_check_player_lookup(self):
+		# known urls of a kgs archive page
+		self.assertUsesIndex(Sgf.objects.filter(urlto__in=['http://a', 'http://b']).values_list('urlto', flat=True), 'urlto')
+
+	def test_check_validity_lookups(self):
+		self.assertUsesIndex(LeaguePlayer.objects.filter(kgs_username_lower='climu', event=1), 'kgs_username_lower')
+		self.assertUsesIndex(Sgf.objects.filter(check_code='58.365'), 'check_code')
+
+	def test_create_game_lookup(self):
+		self.assertUsesIndex(LeaguePlayer.objects.filter(event=1, kgs_username_lower__in=['climu', 'nomenest']), 'kgs_username_lower')
+
+
+class KgsArchiveTests(SimpleTestCase):
+	'''parse_kgs_archive on gameArchives.jsp pages kept in testdata/kgs_archives.'''
+
+	def parse(self, name):
+		with open(os.path.join(KGS_ARCHIVES_DIR, name), encoding='utf-8') as f:
+			return utils.parse_kgs_archive(f.read())
+
+	def test_games_reviews_and_private_games(self):
+		# private games (no link) are skipped, reviews and demonstrations (one player cell) are reviews.
+		self.assertEqual(self.parse('climu-2017-1.html'), [
+			{'url': 'http://files.gokgs.com/games/2017/1/29/climu-nomenest.sgf', 'game_type': 'Ranked'},
+			{'url': 'http://files.gokgs.com/games/2017/1/28/climu-2.sgf', 'game_type': 'review'},
+			{'url': 'http://files.gokgs.com/games/2017/1/20/Tenuki-climu.sgf', 'game_type': 'Free'},
+			{'url': 'http://files.gokgs.com/games/2017/1/12/climu-nomenest-2.sgf', 'game_type': 'Ranked'},
+			{'url': 'http://files.gokgs.com/games/2017/1/5/climu-Agnes-3.sgf', 'game_type': 'Rengo'},
+			{'url': 'http://files.gokgs.com/games/2017/1/2/climu.sgf', 'game_type': 'review'},
+		])
+
+	def test_private_review(self):
+		self.assertEqual(self.parse('nomenest-2016-12.html'), [
+			{'url': 'http://files.gokgs.com/games/2016/12/31/nomenest-Sarah.sgf', 'game_type': 'Ranked'},
+			{'url': 'http://files.gokgs.com/games/2016/12/24/Sarah-nomenest.sgf', 'game_type': 'Teaching'},
+		])
+
+	def test_no_games(self):
+		# the only table is the calendar: none of its rows is a game
+		self.assertEqual(self.parse('Tenuki-2017-2.html'), [])
+
+
+@mock.patch.object(utils, 'KGS_BACKOFF', 0)
+class FetchAllTests(SimpleTestCase):
+	'''fetch_all retries transient kgs errors, a bounded number of times.'''
+
+	def fetch(self, errors):
+		calls = []
+		def func(item):
+			calls.append(item)
+			if errors:
+				raise errors.pop(0)
+			return 'ok'
+		results = list(utils.fetch_all(func, ['a'], rate=1000))
+		return results, calls
+
+	def http_error(self, status):
+		response = requests.Response()
+		response.status_code = status
+		return requests.HTTPError(response=response)
+
+	def test_transient_errors_are_retried(self):
+		results, calls = self.fetch([requests.ConnectionError(), self.http_error(503)])
+		self.assertEqual(results, [('a', 'ok', None)])
+		self.assertEqual(len(calls), 3)
+
+	def test_attempts_are_bounded(self):
+		error = requests.Timeout()
+		results, calls = self.fetch([error] * 10)
+		self.assertEqual(results, [('a', None, error)])
+		self.assertEqual(len(calls), utils.KGS_ATTEMPTS)
+
+	def test_client_errors_are_not_retried(self):
+		error = self.http_error(404)
+		results, calls = self.fetch([error])
+		self.assertEqual(results, [('a', None, error)])
+		self.assertEqual(len(calls), 1)
+
+
+class GamesPageStartTests(SimpleTestCase):
+	'''games_page_start falls back to the first page on get parameters it can't use.'''
+
+	def start(self, query):
+		return games_page_start(RequestFactory().get('/league/games/', query))
+
+	def test_valid_start(self):
+		date, pk = self.start({'date': '2017-01-02T10:00:00', 'pk': '12'})
+		self.assertEqual((date.year, date.month, date.day, pk), (2017, 1, 2, 12))
+
+	def test_invalid_date(self):
+		self.assertEqual(self.start({'date': '2017-13-01T00:00', 'pk': '1'}), (None, None))
+
+	def test_invalid_pk(self):
+		self.assertEqual(self.start({'date': '2017-01-02T10:00:00', 'pk': '9' * 30}), (None, None))
+		self.assertEqual(self.start({'date': '2017-01-02T10:00:00', 'pk': 'x'}), (None, None))
+		self.assertEqual(self.start({}), (None, None))
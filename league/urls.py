@@ -25,12 +25,15 @@ urlpatterns = [
     url(r'^account/$', views.account, name='league_account'),
     url(r'^account/(?P<user_name>[\w.@+-]+)/$', views.account,name='league_account'),
     url(r'^scraper/$', views.scraper, name='scraper'),
+    url(r'^scraper/metrics/$', views.scraper_metrics, name='scraper_metrics'),
 
     url(r'^admin/$', views.admin, name='admin'),
+    url(r'^admin/scraper/$', views.scraper_dashboard, name='scraper_dashboard'),
     url(r'^admin/sgf/(?P<sgf_id>[0-9]+)/$', views.sgf_view, name='sgf_edit'),
     url(r'^admin/handle-upload-sgf/$', views.handle_upload_sgf, name='handle_upload_sgf'),
     url(r'^admin/upload-sgf/$', views.upload_sgf, name='upload_sgf'),
     url(r'^admin/create-sgf/$', views.create_sgf, name='create_sgf'),
     url(r'^admin/send-mail/$', views.send_user_mail, name='send_email'),
     url(r'^admin/update-all-sgf/$', views.update_all_sgf, name='update_all_sgf'),
+    url(r'^admin/update-all-sgf/status/$', views.update_all_sgf_status, name='update_all_sgf_status'),
 ]
@@ -1,9 +1,13 @@
 # library of useful fonctions
 
-from bs4 import BeautifulSoup
+from html.parser import HTMLParser
 import requests
+from requests.adapters import HTTPAdapter
 import re
 import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 def check_byoyomi(s):
 	'''check if a string is a correct byo-yomi time: at least '3x30 byo-yomi'
@@ -41,43 +45,290 @@ def extract_players_from_url(url):
 		return {'white':white,'black':black} #if unproper url, black is not define
 
 
-def ask_kgs(kgs_username,year,month):
+# Everything that talks to gokgs.com goes through one session:
+# connections are kept alive and pooled between requests (and between the scraper threads).
+# No retries in the adapter: they would bypass the scraper rate limiter and kgs_stats.
+# fetch_all retries connection errors and 5xx itself (see KGS_ATTEMPTS).
+# A request that still fails leaves its ScraperTask to its lease and is tried again by a later run.
+KGS_TIMEOUT = (5, 30) #connect, read (seconds)
+KGS_ATTEMPTS = 3 # calls of a failing request in fetch_all, first one included
+KGS_BACKOFF = 1 # seconds before the first retry, doubled for each one
+kgs_session = requests.Session()
+kgs_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0)
+kgs_session.mount('http://', kgs_adapter)
+kgs_session.mount('https://', kgs_adapter)
+
+class KgsStats(object):
+	'''Count our kgs requests, the time we waited for them and their http status.
+	Safe to share between threads. The scraper resets it at the beginning of each run.'''
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.requests = 0
+			self.time = 0.0
+			self.status = {}
+
+	def add(self, status, duration):
+		with self.lock:
+			self.requests += 1
+			self.time += duration
+			self.status[status] = self.status.get(status, 0) + 1
+
+	def snapshot(self):
+		with self.lock:
+			return {'requests': self.requests, 'time': self.time, 'status': dict(self.status)}
+
+kgs_stats = KgsStats()
+
+def kgs_get(url,headers=None):
+	start = time.monotonic()
+	try:
+		r = kgs_session.get(url,headers=headers,timeout=KGS_TIMEOUT)
+	except requests.RequestException:
+		kgs_stats.add('error', time.monotonic() - start)
+		raise
+	kgs_stats.add(str(r.status_code), time.monotonic() - start)
+	return r
+
+
+def ask_kgs(kgs_username,year,month,validators=None):
 	''' return a list of dic: { urlto, game_type} of games for the selected user, year and month
 	We have to check game_type here because it's not in the sgf but only on kgs website
-	Do not perform any check on players or whatever.'''
+	Do not perform any check on players or whatever.
+	validators is an optional dict {'etag', 'last_modified'} from our last request of this page.
+	If provided, the request is conditional: we return None if the page didn't change,
+	and validators is updated with the new values otherwise.'''
 
 	if len(str(month)):
 		month='0'+str(month)
 	url = 'https://www.gokgs.com/gameArchives.jsp?user=' + str(kgs_username) + '&year=' + str(year) + '&month='+ str(month)
-	r = requests.get(url)
-	t = r.text
-	soup=BeautifulSoup(t,"html5lib")
-	#old method that just get the links to games
-	#we need type too to exclude reviews :(
-	#la = soup.find_all(href=re.compile('^http://files.gokgs.com/games/'))
-
-	trs=soup.table.find_all('tr')
+	headers = {}
+	if validators is not None:
+		if validators.get('etag'):
+			headers['If-None-Match'] = validators['etag']
+		if validators.get('last_modified'):
+			headers['If-Modified-Since'] = validators['last_modified']
+	r = kgs_get(url,headers)
+	if r.status_code == 304:
+		return None
+	r.raise_for_status()
+	if validators is not None:
+		validators['etag'] = r.headers.get('ETag','')
+		validators['last_modified'] = r.headers.get('Last-Modified','')
+	return parse_kgs_archive(r.text)
+
+
+class KgsArchiveParser(HTMLParser):
+	'''Collect the cells of the first table of a kgs archive page, in one pass.
+	rows is a list of rows, a row a list of cells {'text', 'link', 'href'}:
+	text of the cell, text and href of its first link (None if it has no link).
+	Everything after the first table is ignored.'''
+
+	def __init__(self):
+		HTMLParser.__init__(self, convert_charrefs=True)
+		self.rows = []
+		self.in_table = False
+		self.done = False
+		self.row = None
+		self.cell = None
+		self.link = None
+
+	def close_cell(self):
+		if self.cell is not None and self.row is not None:
+			self.cell['text'] = ''.join(self.cell['text'])
+			if self.cell['link'] is not None:
+				self.cell['link'] = ''.join(self.cell['link'])
+			self.row.append(self.cell)
+		self.cell = None
+		self.link = None
+
+	def close_row(self):
+		self.close_cell()
+		if self.row is not None:
+			self.rows.append(self.row)
+		self.row = None
+
+	def handle_starttag(self, tag, attrs):
+		if self.done:
+			return
+		if tag == 'table':
+			self.in_table = True
+		elif not self.in_table:
+			return
+		elif tag == 'tr':
+			self.close_row()
+			self.row = []
+		elif tag == 'td':
+			self.close_cell()
+			self.cell = {'text': [], 'link': None, 'href': None}
+		elif tag == 'a' and self.cell is not None and self.cell['link'] is None:
+			self.link = []
+			self.cell['link'] = self.link
+			self.cell['href'] = dict(attrs).get('href')
+
+	def handle_endtag(self, tag):
+		if self.done or not self.in_table:
+			return
+		if tag == 'a':
+			self.link = None
+		elif tag == 'td':
+			self.close_cell()
+		elif tag == 'tr':
+			self.close_row()
+		elif tag == 'table':
+			self.close_row()
+			self.done = True
+
+	def handle_data(self, data):
+		if self.cell is not None:
+			self.cell['text'].append(data)
+			if self.link is not None:
+				self.link.append(data)
+
+
+def parse_kgs_archive(html):
+	''' return the list of dic: { urlto, game_type} of the viewable games of a kgs archive page.'''
+	# the games are in the first table: we don't even read the rest of the page
+	end = html.find('</table>')
+	if end != -1:
+		html = html[:end+8]
+	parser = KgsArchiveParser()
+	parser.feed(html)
+	parser.close()
 	l=[]
-	for tr in trs[1:]:
-		tds=tr.find_all('td')
-		if tds[0].a.get_text()=='Yes':
-			url = tds[0].a.get('href')
+	#first row is the header
+	for tds in parser.rows[1:]:
+		if len(tds) >= 6 and tds[0]['link']=='Yes':
+			url = tds[0]['href']
 			#crappy way to detect if a game is a review the #of row in the table... :(
 			if len(tds)==6 : #it's a review !
 				game_type = 'review'
 			else:
-				game_type = tds[5].get_text()
+				game_type = tds[5]['text']
 			l.append({'url':url,'game_type': game_type})
 
 	return l
 
 
+def download_sgf(url):
+	'''get the sgf text of a kgs archive game'''
+	r = kgs_get(url)
+	r.raise_for_status()
+	return r.text
+
+
+def is_transient(error):
+	'''True if a kgs request failing with error is worth trying again: connection errors, timeouts and 5xx.'''
+	if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+		return True
+	return isinstance(error, requests.HTTPError) and error.response is not None and error.response.status_code >= 500
+
+
+class RateLimiter(object):
+	'''Spread calls so that no more than rate calls per second are started.
+	Safe to share between threads.'''
+
+	def __init__(self, rate):
+		self.interval = 1.0 / rate
+		self.lock = threading.Lock()
+		self.next_time = time.monotonic()
+
+	def wait(self, deadline=None):
+		# return False without waiting if our turn would come after deadline
+		with self.lock:
+			now = time.monotonic()
+			start = max(now, self.next_time)
+			if deadline is not None and start > deadline:
+				return False
+			self.next_time = start + self.interval
+		if start > now:
+			time.sleep(start - now)
+		return True
+
+
+def fetch_all(func, items, rate=1, workers=4, deadline=None):
+	''' call func(item) for all items with a pool of workers threads, starting at most rate calls per second.
+	yield (item, result, error) tuples as soon as calls complete. error is None if the call succeeded.
+	If a call would start after deadline (a time.monotonic() value), it is skipped and yield with error 'deadline'.
+	A call failing with a transient error (see is_transient) is tried again after KGS_BACKOFF, 2*KGS_BACKOFF...
+	up to KGS_ATTEMPTS calls. Retries wait for the rate limiter like any call. If a retry would start after
+	deadline, the last error is yield.
+	func must not touch the db: it's run outside of the main thread.'''
+
+	limiter = RateLimiter(rate)
+
+	def call(item):
+		if not limiter.wait(deadline):
+			return (item, None, 'deadline')
+		for attempt in range(1, KGS_ATTEMPTS + 1):
+			try:
+				return (item, func(item), None)
+			except Exception as e:
+				error = e
+			if attempt == KGS_ATTEMPTS or not is_transient(error):
+				break
+			backoff = KGS_BACKOFF * 2 ** (attempt - 1)
+			if deadline is not None and time.monotonic() + backoff > deadline:
+				break
+			time.sleep(backoff)
+			if not limiter.wait(deadline):
+				break
+		return (item, None, error)
+
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = [executor.submit(call, item) for item in items]
+		for future in as_completed(futures):
+			yield future.result()
+
+
+# a node start or a property: its identifier, its first value and the other ones if any.
+# Inside a value, \] is an escaped ]. Values regex is unrolled ([^\\\]]* first) to keep the scan fast.
+SGF_VALUE = r'\[([^\\\]]*(?:\\.[^\\\]]*)*)\]'
+# a property and its values. Only the first value is captured.
+SGF_PROPERTY = re.compile(r'([A-Za-z]+)\s*' + SGF_VALUE + r'(?:\s*\[[^\\\]]*(?:\\.[^\\\]]*)*\])*', re.S)
+SGF_ESCAPE = re.compile(r'\\(\r\n|\n\r|.)', re.S)
+
+def sgf_unescape(value):
+	# soft line breaks are removed, other escaped chars are kept
+	return SGF_ESCAPE.sub(lambda m: '' if m.group(1) in ('\r\n','\n\r','\n','\r') else m.group(1), value)
+
+# The whole root node, matched at the start of the sgf: (; then its properties.
+SGF_ROOT = re.compile(r'\s*\(\s*;(?:\s*[A-Za-z]+(?:\s*\[[^\\\]]*(?:\\.[^\\\]]*)*\])+)*', re.S)
+# KGS writes the move nodes as ;B[pd]BL[58.365]C[...]: the time left comes right after the move.
+SGF_MOVE = re.compile(r';\s*([BW])\[([^\]]*)\]\s*(?:[BW]L\[([^\]]*)\])?')
+SGF_BLACK_TIME = re.compile(r';\s*B\[[^\]]*\]\s*BL\[([^\]]*)\]')
+
+def tokenize_sgf_root(sgf_string):
+	'''return (root, end):
+	root is a dict of the root node properties (first value only), unescaped.
+	end is the position of the first move node in sgf_string.
+	Property values are matched whole, escaped ] included: a ; or a B[ inside a comment is not a node.'''
+	m = SGF_ROOT.match(sgf_string)
+	end = m.end() if m else 0
+	root = {}
+	for ident, value in SGF_PROPERTY.findall(sgf_string,0,end):
+		if ident not in root:
+			root[ident] = sgf_unescape(value) if '\\' in value else value
+	return (root, end)
+
+def tokenize_sgf(sgf_string):
+	'''scan a sgf string once and return (root, moves):
+	root is as in tokenize_sgf_root.
+	moves is a list of (color, coordinates, time_left) for every B and W node.
+	time_left is the BL/WL value following the move, or '' if there is none.
+	Variations are not handled: KGS archive games don't have any.
+	parse_sgf_string doesn't need the moves themselves and doesn't build this list.'''
+	root, end = tokenize_sgf_root(sgf_string)
+	return (root, SGF_MOVE.findall(sgf_string,end))
+
 def parse_sgf_string(sgf_string):
 	'''parse a sgf from a string and return a dict:
 	bplayer,wplayer,time,byo,result,handi,komi,size,rule,date,place'''
 
-	#First remove all espaces and new lines from the sgf
-	sgf_string=sgf_string.replace(chr(160),'').replace(chr(10),'').replace(chr(13),'')
 	prop= {
 		'DT' : 'date',
 		'RE' : 'result',
@@ -90,27 +341,22 @@ def parse_sgf_string(sgf_string):
 		'OT' : 'byo',
 		'PC' : 'place'
 	}
+	root, end = tokenize_sgf_root(sgf_string)
 	out={}
 	for key in prop:
-		p = sgf_string.find(key+'[') #find the key and get the index
-		if p != -1 :
-			q = sgf_string.find(']',p) #find the end of the tag
-			out[prop[key]]=sgf_string[p+3:q]
+		if key in root:
+			#remove all espaces and new lines from the value
+			out[prop[key]]=root[key].replace(chr(160),'').replace(chr(10),'').replace(chr(13),'')
 	#convert string date to date object
 	if 'date' in out:
 		out['date']=datetime.datetime.strptime(out['date'],"%Y-%m-%d")
 	else:
 		 out['date']=None
 	#counting the number of moves. Note that there could be a +-1 diff, but we don't really care
-	out['number_moves'] = 2*sgf_string.count(';B[')
-	# We create a unique string based on exact time (ms) 5 first black moves where played.
-	code=""
-	q=0
-	for n in range(0,5):
-		p=sgf_string.find('BL[')
-		if p!=-1:
-			q=sgf_string.find(']',p)
-			code+=sgf_string[p+3:q]
-	out['check_code']=code
+	out['number_moves'] = 2*sgf_string.count(';B[',end)
+	# We create a unique string based on the time left after the first black move.
+	# It's repeated 5 times to stay equal to the codes already stored in db (check_validity compares them)
+	m = SGF_BLACK_TIME.search(sgf_string,end)
+	out['check_code'] = 5*m.group(1) if m else ""
 
 	return out
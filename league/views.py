@@ -1,13 +1,19 @@
 from django.shortcuts import get_object_or_404, render
 from django.template import loader
-from django.db import models
-from django.http import HttpResponse, HttpResponseRedirect,Http404
-from .models import Sgf,LeaguePlayer,User,LeagueEvent,Division,Game,Registry, User, is_league_admin, is_league_member
+from django.db import models, transaction
+from django.http import HttpResponse, HttpResponseRedirect,Http404, JsonResponse
+from .models import Sgf,LeaguePlayer,User,LeagueEvent,Division,Game,Registry, User, SgfReparseJob, ScraperRun, ScraperTask, UserStats, EventSummary, is_league_admin, is_league_member
 from .forms import  SgfAdminForm,ActionForm,LeagueRolloverForm,UploadFileForm
 import datetime
+import time
+import uuid
 from django.http import Http404
 from django.core.urlresolvers import reverse
 from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils import timezone
+from django.utils.http import urlencode
+from django.utils.functional import SimpleLazyObject
 from django.contrib.auth.decorators import login_required
 from django import forms
 from django.contrib.auth.models import  Group
@@ -18,13 +24,22 @@ from . import utils
 
 discord_url_file = "/etc/discord_url.txt"
 
+# number of tasks a scraper worker claims at once
+SCRAPER_BATCH = 50
+
 def scraper():
 	#the big scraper thing
-	# To prevent overrequestion kgs, do one of the 3 actions only:
+	# Once the kgs delay is over, we drain as much of the backlog as our kgs budget allows:
 	#1 check time since get from kgs
-	#2 look for some sgfs that analyse and maybe pulled as games
-	#3 check a player
-
+	#2 look for some sgfs that we analyse and maybe record as games
+	#3 when no sgf is waiting, check the players
+	# kgs requests run concurrently (see utils.fetch_all) but never faster than the registry kgs_rate.
+	# All db work stays in this thread.
+	# What the run did is recorded in a ScraperRun.
+
+	start = time.monotonic()
+	run = ScraperRun()
+	utils.kgs_stats.reset()
 	event=Registry.get_primary_event()
 	#1check time since get from kgs
 	now=datetime.datetime.now().replace(tzinfo=None)
@@ -33,61 +48,155 @@ def scraper():
 	delta_sec = delta.total_seconds()
 	kgs_delay = Registry.get_kgs_delay()
 	if delta_sec < kgs_delay: #we can't scrape yet
+		run.finish(start,utils.kgs_stats.snapshot())
 		return
-	#2 look for some sgfs that we analyse and maybe record as games
-	sgfs=Sgf.objects.filter(p_status=2)
-	if len(sgfs)==0 :
-		sgfs=Sgf.objects.filter(p_status=1)
-	if len(sgfs)>0 :
-		sgf = sgfs[0]
-		#parse the sgf datas to populate the rows
-		sgf = sgf.parse()
-		#if the sgf doesn't have a result (unfinished game) we just delete it
-		if sgf.result == '?':
-			sgf.delete()
-		else:
-			sgf = sgf.check_validity()
-			sgf.save()
-			if sgf.league_valid:
-				Game.create_game(sgf)
-		out = sgf
-	#3 no games to scrap let's check a player
-	else :
+	run.action = 'idle'
+	kgs = Registry.get_kgs_settings()
+	deadline = time.monotonic() + kgs['budget']
+	# our tasks are leased until the end of the run, with a margin
+	worker = uuid.uuid4().hex
+	lease = kgs['budget'] + 60
+	new_sweep = False
+	while time.monotonic() < deadline:
+		ScraperTask.refill(event)
+		#2 look for some sgfs that we analyse and maybe record as games. Admin ones (p_status=2) first
+		tasks = ScraperTask.claim(worker,'sgf',SCRAPER_BATCH,lease)
+		if len(tasks) > 0:
+			run.add_phase('sgfs')
+			scrap_sgfs(tasks,kgs,deadline,run)
+			continue
+		#3 no games to scrap let's check the players
+		tasks = ScraperTask.claim(worker,'player',SCRAPER_BATCH,lease)
+		if len(tasks) > 0:
+			run.add_phase('players')
+			scrap_players(tasks,kgs,deadline,run)
+			continue
+		#if everyone has been checked, we start a new sweep. Only once per run.
 		players=LeaguePlayer.objects.filter(event=event)
-		#if everyone has been checked.
-		if not(players.filter(p_status__gt =0).exists()):
-			players.update(p_status=1)
-		if players.filter(p_status =2).exists():
-			player=player.filter(p_status = 2)[0]
-			player.check_player()
-		else:
-			player = players.filter(p_status = 1)[0]
-			player.check_player()
-		out=player
+		if new_sweep or players.filter(p_status__gt =0).exists():
+			break
+		players.update(p_status=1)
+		new_sweep = True
 	Registry.set_time_kgs(now)
+	run.finish(start,utils.kgs_stats.snapshot())
 	return
 
+def scrap_sgfs(tasks,kgs,deadline,run):
+	# parse, check and maybe record as games the sgfs of a list of tasks.
+	# sgfs with p_status=1 are downloaded from kgs first, concurrently.
+	# The tasks we couldn't download are left to their lease: they will be claimed again later.
+	to_download = []
+	for task in tasks:
+		if task.sgf.p_status == 1:
+			to_download.append(task)
+		else:
+			scrap_sgf(task.sgf,run)
+			task.done()
+	for task, sgf_text, error in utils.fetch_all(lambda task: utils.download_sgf(task.sgf.urlto),to_download,kgs['rate'],kgs['workers'],deadline):
+		if error is None:
+			scrap_sgf(task.sgf,run,sgf_text)
+			task.done()
+
+def scrap_sgf(sgf,run,sgf_text=None):
+	#a sgf can have been scraped by a worker that died before deleting its task
+	if sgf.p_status == 0:
+		return
+	#parse the sgf datas to populate the rows
+	start = time.monotonic()
+	sgf = sgf.parse(sgf_text)
+	run.parse_time += time.monotonic() - start
+	run.sgfs_scraped += 1
+	#if the sgf doesn't have a result (unfinished game) we just delete it
+	if sgf.result == '?':
+		sgf.delete()
+		run.reject('unfinished game')
+	else:
+		sgf = sgf.check_validity()
+		sgf.save()
+		if not sgf.league_valid:
+			run.reject(sgf.message)
+		elif Game.create_game(sgf):
+			run.games_created += 1
+		else:
+			run.reject('game not created')
+
+def scrap_players(tasks,kgs,deadline,run):
+	# ask kgs the games of the players of a list of tasks concurrently and check them.
+	# As for sgfs, failed tasks are left to their lease.
+	for task, list_urlto_games, error in utils.fetch_all(lambda task: task.player.ask_kgs(),tasks,kgs['rate'],kgs['workers'],deadline):
+		if error is None:
+			task.player.check_player(list_urlto_games,asked=True)
+			run.players_checked += 1
+			task.done()
+
 def scraper_view(request):
 	scraper()
 	return httpResponse('scraped')
 
+GAMES_PER_PAGE = 50
+MAX_PK = 2**31 - 1 # games pk is a db integer
+
+# Event pages fragments are cached under the event version (see LeagueEvent.get_version):
+# they never get stale, the timeout only frees the cache from old versions.
+EVENT_FRAGMENT_TTL = 3600
+
+def games_page_start(request):
+	'''(date, pk) of the last game of the previous page from the get parameters, (None, None) for the first page.'''
+	# anything we can't use (a bad date, a pk out of the db integer range...) gives the first page.
+	try:
+		date = parse_datetime(request.GET.get('date',''))
+		pk = int(request.GET.get('pk',''))
+	except (ValueError, OverflowError):
+		return (None, None)
+	if date is None or not 0 <= pk <= MAX_PK:
+		return (None, None)
+	return (date, pk)
+
+def games_page(request,games):
+	'''keyset pagination of a Game queryset, newest games first.
+	A page starts after the (sgf date, pk) of the last game of the previous page, given as date and pk get parameters.
+	Only the columns the games tables display are loaded, with their players in the same query.
+	return (list of the games of the page, query string of the next page or None)'''
+	games = games.select_related('sgf','white__user','black__user').only(
+		'winner','sgf','sgf__date','sgf__result',
+		'white','white__user','white__user__username','white__user__kgs_username',
+		'black','black__user','black__user__username','black__user__kgs_username',
+	).order_by('-sgf__date','-pk')
+	date, pk = games_page_start(request)
+	if pk is not None:
+		games = games.filter(Q(sgf__date__lt=date)|Q(sgf__date=date,pk__lt=pk))
+	games = list(games[:GAMES_PER_PAGE+1])
+	next_page = None
+	if len(games) > GAMES_PER_PAGE:
+		games = games[:GAMES_PER_PAGE]
+		last = games[-1]
+		next_page = urlencode({'date':last.sgf.date.isoformat(),'pk':last.pk})
+	return (games,next_page)
+
 def games(request,event_id=None):
 	if event_id == None:
-		games=Game.objects.all().order_by('-sgf__date')
+		games, next_page = games_page(request,Game.objects.all())
 		context = {
 			'games': games,
+			'next_page': next_page,
 				}
 		template = loader.get_template('league/archives_games.html')
 
 	else:
 		event = get_object_or_404(LeagueEvent,pk=event_id)
 		close = event.end_time.replace(tzinfo=None) < datetime.datetime.now().replace(tzinfo=None)
-		games=Game.objects.filter(white__event=event).order_by('-sgf__date')
+		# the page is only loaded if the template fragment is not in cache.
+		page = SimpleLazyObject(lambda: dict(zip(('games','next_page'),games_page(request,Game.objects.filter(white__event=event)))))
+		# the fragment key uses the parsed page start: junk get parameters all give the first page.
+		date, pk = games_page_start(request)
 		template = loader.get_template('league/games.html')
 		context = {
-			'games': games,
+			'page': page,
+			'page_start': '' if pk is None else date.isoformat() + '_' + str(pk),
+			'fragment_ttl': EVENT_FRAGMENT_TTL,
 			'event':event,
 			'close':close,
+			'version':event.get_version(),
 			}
 	return HttpResponse(template.render(context, request))
 
@@ -103,13 +212,23 @@ def results(request,event_id=None,division_id=None):
 	else:
 		division = get_object_or_404(Division,pk=division_id)
 	template = loader.get_template('league/results.html')
-	players=LeaguePlayer.objects.filter(division=division).order_by('-score')
+
+	def get_table():
+		players=list(LeaguePlayer.objects.filter(division=division).select_related('user').order_by('-score'))
+		if division == None:
+			crosstable = []
+		else:
+			crosstable = division.get_crosstable(players)
+		return {'players':players,'crosstable':crosstable}
 	close = event.end_time.replace(tzinfo=None) < datetime.datetime.now().replace(tzinfo=None)
 	context = {
-		'players':players,
+		# the crosstable is only built if the template fragment is not in cache.
+		'table':SimpleLazyObject(get_table),
 		'event':event,
 		'division':division,
 		'close' : close,
+		'version':event.get_version(),
+		'fragment_ttl': EVENT_FRAGMENT_TTL,
 		}
 	return HttpResponse(template.render(context, request))
 
@@ -117,7 +236,7 @@ def results(request,event_id=None,division_id=None):
 
 def archives(request):
 		primary_event = Registry.get_primary_event()
-		events = LeagueEvent.objects.all()
+		events = LeagueEvent.objects.select_related('summary')
 
 		context = {
 		'events':events,
@@ -138,7 +257,8 @@ def event(request,event_id=None,division_id=None,):
 	context = {
 		'event':event,
 		'close':close,
-
+		'version':event.get_version(),
+		'fragment_ttl': EVENT_FRAGMENT_TTL,
 		}
 	template = loader.get_template('league/event.html')
 	return HttpResponse(template.render(context, request))
@@ -146,7 +266,7 @@ def event(request,event_id=None,division_id=None,):
 def players(request,event_id=None,division_id=None):
 	#if no event is provided, we show all the league members
 	if event_id == None:
-		users=User.objects.filter(groups__name='league_member')
+		users=User.objects.filter(groups__name='league_member').select_related('stats')
 		context = {
 			'users':users,
 		}
@@ -166,7 +286,10 @@ def players(request,event_id=None,division_id=None):
 			'event':event,
 			'players':players,
 			'close' : close,
-			'divisions':divisions
+			'divisions':divisions,
+			'division_id':division_id,
+			'version':event.get_version(),
+			'fragment_ttl': EVENT_FRAGMENT_TTL,
 		}
 		template = loader.get_template('league/players.html')
 	return HttpResponse(template.render(context, request))
@@ -183,8 +306,7 @@ def account(request,user_name=None):
 		else:
 			return HttpResponseRedirect('/')# maybe a view with a list of all our users might be cool redirection here
 	else:
-		#user = get_object_or_404(User,username = user_name)
-		user= User.objects.get(username=user_name)
+		user = get_object_or_404(User.objects.select_related('stats'),username = user_name)
 
 	if not is_league_member(user): return HttpResponseRedirect('/')
 
@@ -201,21 +323,47 @@ def account(request,user_name=None):
 					return HttpResponseRedirect(reverse('league:league_account'))
 
 	else:
-		players = user.leagueplayer_set.order_by('-pk')
-		games = Game.objects.filter(Q(black__in = players)|Q(white__in = players))
-		if user.is_in_primary_event():
-			active_player = user.get_primary_event_player()
-			opponents = LeaguePlayer.objects.filter(division=active_player.division).order_by('-score')
+		# The number of queries doesn't depend on how long the user has been with us:
+		# all his players at once, the opponents of his active player with their results,
+		# and one page of the games of one event.
+		players = list(user.leagueplayer_set.select_related('event','division__league_event').order_by('-pk'))
+		active_player = False
+		for player in players:
+			if player.event_id == primary_event.pk:
+				active_player = player
+		if active_player:
+			opponents = list(LeaguePlayer.objects.filter(division=active_player.division_id).select_related('user').order_by('-score'))
+			results = {}
+			for opponent_id, game_id, win in active_player.player_results.values_list('opponent_id','game_id','win'):
+				results.setdefault(opponent_id,[]).append((game_id,1 if win else 0))
+			for opponent in opponents:
+				opponent.results_against = results.get(opponent.pk,[])
 		else:
-			active_player = False
 			opponents = []
+		# games are shown one event at a time, the active one by default.
+		games_player = active_player or (players[0] if players else None)
+		event_id = request.GET.get('event','')
+		if event_id.isdigit():
+			for player in players:
+				if player.event_id == int(event_id):
+					games_player = player
+		if games_player is None:
+			games, next_page = [], None
+			base_query = ''
+		else:
+			games, next_page = games_page(request,Game.objects.filter(Q(black=games_player)|Q(white=games_player)))
+			base_query = urlencode({'event':games_player.event_id})
 		context = {
 		'players' : players,
 		'primary_event':primary_event,
 		'games' : games,
+		'games_player' : games_player,
+		'next_page' : next_page,
+		'base_query' : base_query,
 		'active_player' : active_player,
 		'opponents' : opponents,
 		'user' :user,
+		'stats' : user.get_stats(),
 		}
 		template = loader.get_template('league/account.html')
 		return HttpResponse(template.render(context, request))
@@ -341,7 +489,7 @@ def admin(request):
 					messages.success(request,message)
 					return HttpResponseRedirect(reverse('league:admin'))
 	else:
-		sgfs = Sgf.objects.filter(league_valid=False,p_status = 0)
+		sgfs = Sgf.objects.filter(league_valid=False,p_status = 0).defer('sgf_text')
 		new_users=User.objects.filter(groups__name='new_user')
 		form = UploadFileForm()
 		context={
@@ -389,12 +537,7 @@ def rollover(request):
 	if request.method == 'POST':
 		form = LeagueRolloverForm(from_event,to_event,request.POST)
 		if form.is_valid():
-			for player in from_event.get_players():
-				if player.is_active():
-					new_division = Division.objects.get(pk=form.cleaned_data['player_'+str(player.pk)])
-					new_player = LeaguePlayer(user=player.user,event = to_event,kgs_username = player.kgs_username,division=new_division)
-					new_player.previous_division=player.division
-					new_players[new_division.name].append(new_player)
+			new_players = form.get_plan()
 			#Admin have a preview so we are sure form is not dumber than the admin. We will display the save button in template
 			preview=True
 	else:
@@ -425,13 +568,21 @@ def proceed_rollover(request):
 	to_event = LeagueEvent.objects.filter(pk=from_event.pk+1).first()
 	if request.method == 'POST':
 		form = LeagueRolloverForm(from_event,to_event,request.POST)
-		if form.is_valid():
-			n=0
-			for player in from_event.get_players():
-				if player.is_active():
-						n+=1
-						new_division = Division.objects.get(pk=form.cleaned_data['player_'+str(player.pk)])
-						new_player = LeaguePlayer.objects.create(user=player.user,event = to_event,kgs_username = player.kgs_username,division=new_division)
+		if not form.is_valid():
+			raise Http404("What are you doing here ?")
+		new_players = [player for players in form.get_plan().values() for player in players]
+		with transaction.atomic():
+			# Lock the new event so two submits can't both populate it.
+			LeagueEvent.objects.select_for_update().get(pk=to_event.pk)
+			if to_event.leagueplayer_set.exists():
+				message = "Something strange: you tryed to rollover to a league with players already in it"
+				messages.success(request,message)
+				return HttpResponseRedirect(reverse('league:admin'))
+			LeaguePlayer.objects.bulk_create(new_players)
+			UserStats.rebuild([player.user_id for player in new_players])
+		EventSummary.refresh(to_event)
+		LeagueEvent.bump_version(to_event.pk)
+		n = len(new_players)
 		message ="The new "+ to_event.name +" was populated with "+ str(n) +" players."
 		messages.success(request,message)
 		return HttpResponseRedirect(reverse('league:admin'))
@@ -472,22 +623,72 @@ def update_all_sgf(request):
 	We just display a confirmation page with a warning if no post request.
 	For now, we will just update the check_code field.
 	Latter, we might add a select form to select what field(s) we want update
+	The post request only starts a SgfReparseJob: SgfReparseCronJob does the work in background
+	and the page polls update_all_sgf_status to display the progress.
 	'''
 	if request.method == 'POST':
 		form = form=ActionForm(request.POST)
 		if form.is_valid():
-			sgfs= Sgf.objects.all()
-			for sgf in sgfs:
-				sgf_prop=utils.parse_sgf_string(sgf.sgf_text)
-				sgf.check_code=sgf_prop['check_code']
-				sgf.save()
-			message ="Successfully updated " + str(sgfs.count()) + " sgfs."
+			job = SgfReparseJob.start()
+			message ="Reparsing " + str(job.total) + " sgfs in background."
 			messages.success(request,message)
-			return HttpResponseRedirect(reverse('league:admin'))
+			return HttpResponseRedirect(reverse('league:update_all_sgf'))
 		else:
 			message ="Something went wrong (form is not valid)"
 			messages.success(request,message)
 			return HttpResponseRedirect(reverse('league:admin'))
 	else:
+		context = {
+			'job' : SgfReparseJob.objects.first(),
+		}
+		return render(request,'league/update_all_sgf.html',context)
+
+@login_required()
+@user_passes_test(is_league_admin,login_url="/",redirect_field_name = None)
+def update_all_sgf_status(request):
+	job = SgfReparseJob.objects.first()
+	if job is None:
+		raise Http404("No sgf reparse job")
+	return JsonResponse({
+		'status': job.status,
+		'total': job.total,
+		'done': job.done,
+		'updated': job.updated,
+		'start_time': job.start_time.isoformat(),
+	})
+
+def scraper_metrics(request):
+	'''machine readable state of the scraper: its backlog, its last run and the totals of the last 24 hours'''
+	last_run = ScraperRun.objects.first()
+	if last_run is None:
+		last = None
+	else:
+		last = {
+			'start_time': last_run.start_time.isoformat(),
+			'duration': last_run.duration,
+			'action': last_run.action,
+			'kgs_requests': last_run.kgs_requests,
+			'kgs_time': last_run.kgs_time,
+			'parse_time': last_run.parse_time,
+			'sgfs_scraped': last_run.sgfs_scraped,
+			'players_checked': last_run.players_checked,
+			'games_created': last_run.games_created,
+			'games_rejected': last_run.games_rejected,
+			'http_status': last_run.get_http_status(),
+			'rejections': last_run.get_rejections(),
+		}
+	return JsonResponse({
+		'backlog': ScraperRun.get_backlog(),
+		'last_run': last,
+		'last_24h': ScraperRun.get_totals(timezone.now() - datetime.timedelta(days=1)),
+	})
 
-		return render(request,'league/update_all_sgf.html')
+@login_required()
+@user_passes_test(is_league_admin,login_url="/",redirect_field_name = None)
+def scraper_dashboard(request):
+	context = {
+		'backlog': ScraperRun.get_backlog(),
+		'totals': ScraperRun.get_totals(timezone.now() - datetime.timedelta(days=1)),
+		'runs': ScraperRun.objects.all()[:20],
+	}
+	return render(request,'league/scraper.html',context)
@@ -218,9 +218,16 @@ ACCOUNT_FORMS ={}
 ACCOUNT_SIGNUP_FORM_CLASS = 'league.forms.LeagueSignupForm'
 
 # required by MAchina
+# default cache must be shared by the web server and the cron jobs:
+# the scraper invalidates league caches (crosstables...) when it records a game.
+# League pages fragments and crosstables take many entries: the default MAX_ENTRIES (300)
+# would randomly cull everything, the discord widget included.
+# Don't raise it much more: the file cache lists the whole directory on every set to check it.
 CACHES = {
   'default': {
-    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': os.path.join(BASE_DIR, 'cache'),
+    'OPTIONS': {'MAX_ENTRIES': 3000},
   },
   'machina_attachments': {
     'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
@@ -250,8 +257,15 @@ SECURE_CONTENT_TYPE_NOSNIFF = True
 
 CRON_CLASSES = [
 	'league.cron.ScraperCronJob',
+	'league.cron.SgfReparseCronJob',
+	'home.cron.DiscordCronJob',
 ]
 
+# Discord widget shown on the home page. It's fetched by home.cron.DiscordCronJob
+# and the page only reads the cache. Point the url to a local stub for tests.
+DISCORD_WIDGET_URL = 'https://discordapp.com/api/guilds/287487891003932672/widget.json'
+DISCORD_CACHE_TTL = 15 * 60
+
 SECRET_KEY = 'yourlocalsecretkey'
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 DEBUG = True
@@ -1,3 +1,13 @@
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.core.cache import cache
+from wagtail.wagtaildocs.models import Document
+from .templatetags.wgo_tags import prepared_sgf_key
 
 # Create your models here.
+
+@receiver(post_save, sender=Document)
+@receiver(post_delete, sender=Document)
+def clear_prepared_sgf(sender, instance, **kwargs):
+    cache.delete(prepared_sgf_key(instance.pk))
@@ -1,13 +1,26 @@
 from django import template
+from django.core.cache import cache
 
 register = template.Library()
 
+def prepared_sgf_key(document_id):
+    return 'wgo_prepared_sgf_' + str(document_id)
+
 @register.filter
 def prepare_sgf(value):
+    # value is a wagtail document. The prepared sgf is cached with the name of the file it was read from:
+    # replacing the file changes the name, and wgo.models clears the cache when a document is saved or deleted.
+    # With a warm cache we don't touch the storage at all.
+    key = prepared_sgf_key(value.pk)
+    cached = cache.get(key)
+    if cached is not None and cached[0] == value.file.name:
+        return cached[1]
     f=value.file
     f.open(mode='rb')
     sgf=f.read()
+    f.close()
     sgf=str(sgf,'utf-8')
     sgf=sgf.replace(chr(34), "")
+    cache.set(key, (value.file.name, sgf), None)
     return sgf
 #    return "(;PB[Black]PW[White]RE[B+R];B[qd];W[dd];B[pq];W[dq];B[fc])"
@@ -5,5 +5,6 @@ from . import views
 urlpatterns = [
 
     url(r'^game/(?P<game_id>[0-9]+)/$', views.wgo_game_view,name='game_iframe'),
+    url(r'^game/(?P<game_id>[0-9]+)/sgf/$', views.game_sgf_view,name='game_sgf'),
 
 ]
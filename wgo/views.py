@@ -1,18 +1,43 @@
 from django.shortcuts import render, get_object_or_404
 from django.template import loader
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from league.models import Sgf, Game
-# Create your views here.
+
+# A recorded game never changes: browsers and proxies can keep it.
+GAME_MAX_AGE = 365 * 24 * 3600
+
+def game_sgf_etag(request, game_id):
+    # strong etag: the hash of the sgf, stored with it. The sgf text itself is not read.
+    sgf = Sgf.objects.filter(game__pk=game_id).values_list('pk', 'sgf_hash').first()
+    if sgf is None:
+        return None
+    pk, sgf_hash = sgf
+    if sgf_hash == '':
+        # saved before sgf_hash existed: compute it once
+        sgf_text = Sgf.objects.filter(pk=pk).values_list('sgf_text', flat=True).first()
+        sgf_hash = Sgf.hash_text(sgf_text)
+        Sgf.objects.filter(pk=pk).update(sgf_hash=sgf_hash)
+    return sgf_hash
+
+@cache_control(public=True, max_age=GAME_MAX_AGE)
 def wgo_game_view(request,game_id):
     # display a simple page with only wgo display
     # can easily be iframed.
-    # Note: there might be a better way to dimamicly change a wgo content inside a page.
-    #       I don't know how. wgo-data need sgf data which are inside the db.
-    #       I guess an api:get_sgf_data could work but I have other things to do for now.
-    game =get_object_or_404(Game,pk=game_id)
-    sgf_data=game.sgf.sgf_text
-    sgf_data=sgf_data.replace(chr(34), "")
+    # The page is the same for every game but the sgf url: wgo downloads the sgf itself from game_sgf_view.
+    # Only a cheap check that the game exists: the response is cached for a year.
+    if not Game.objects.filter(pk=game_id).exists():
+        raise Http404("No such game")
     context={
-    'sgf_data' : sgf_data,
+    'game_id' : game_id,
     }
     return render(request,'wgo/wgo_iframe.html', context)
+
+@cache_control(public=True, max_age=GAME_MAX_AGE)
+@condition(etag_func=game_sgf_etag)
+def game_sgf_view(request,game_id):
+    # the raw sgf of a game. Conditional requests get a 304 if the sgf didn't change.
+    game = get_object_or_404(Game.objects.select_related('sgf'),pk=game_id)
+    response = HttpResponse(game.sgf.sgf_text, content_type='application/x-go-sgf; charset=utf-8')
+    return response